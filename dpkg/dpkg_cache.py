@@ -0,0 +1,91 @@
+"""
+Persistent cache of parsed dpkg status files
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+
+CACHE_VERSION = 2
+
+
+def status_identity(status_path):
+    """
+    Identity of a status file. dpkg replaces the status file by renaming a new
+    version over it, hence a change of content always changes the identity.
+    """
+    s = os.stat(status_path)
+    return '%d:%d:%d:%d' % (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns)
+
+
+def cache_filename(cache_dir, status_path):
+    h = hashlib.sha1(os.path.abspath(status_path).encode('utf8')).hexdigest()
+    return os.path.join(cache_dir, 'dpkg_status_%s.sqlite' % h[:16])
+
+
+def open_cache(cache_dir, status_path, identity, decode):
+    """
+    Load the package table from the cache of the given status file.
+
+    :param decode: Callable decode(gen_pkg_key, raw status file record) ->
+        package
+
+    Returns a dict gen_pkg_key -> package or None if no cache exists or it is
+    outdated
+    """
+    filename = cache_filename(cache_dir, status_path)
+    if not os.path.isfile(filename):
+        return None
+
+    conn = None
+    try:
+        conn = sqlite3.connect(filename)
+        row = conn.execute('SELECT version, identity FROM meta').fetchone()
+        if row is None or row[0] != CACHE_VERSION or row[1] != identity:
+            return None
+
+        return {(p, a): decode((p, a), raw) for p, a, raw in
+                conn.execute('SELECT package, architecture, record FROM pkgs')}
+
+    except sqlite3.DatabaseError:
+        return None
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def write_cache(cache_dir, status_path, identity, records):
+    """
+    Store a package table in the cache. The database is built in a temporary
+    file and renamed to its final name so that concurrent readers never see a
+    partially written cache.
+
+    :param records: Iterable of (gen_pkg_key, raw status file record)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.dpkg_status_', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.execute('CREATE TABLE meta (version INTEGER, identity TEXT)')
+            conn.execute('CREATE TABLE pkgs (package TEXT, architecture TEXT, record BLOB, '
+                    'PRIMARY KEY (package, architecture)) WITHOUT ROWID')
+
+            conn.execute('INSERT INTO meta VALUES (?, ?)', (CACHE_VERSION, identity))
+            conn.executemany('INSERT INTO pkgs VALUES (?, ?, ?)',
+                    ((k[0], k[1], raw) for k, raw in records))
+
+            conn.commit()
+
+        finally:
+            conn.close()
+
+        os.replace(tmp, cache_filename(cache_dir, status_path))
+
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -1,5 +1,10 @@
+import bisect
+import collections.abc
+import mmap
 import os
 import re
+import dpkg_cache
+import dpkg_deps
 
 
 AVAILABLE_KEYS = {
@@ -62,20 +67,295 @@ REQUIRED_KEYS = {
 }
 
 
+EXTENDED_KEYS = {
+    'Package',
+    'Architecture',
+    'Auto-Installed'
+}
+
+
 def gen_pkg_key(pkg):
     return (pkg['Package'], pkg['Architecture'])
 
+
+def source_name(pkg):
+    """
+    Name of the source package of a binary package
+    """
+    return pkg.get('Source', pkg['Package']).split(' ', 1)[0]
+
+
+# Fields which are indexed by a derived value; e.g. packages without a Source
+# field are indexed under their own name. 'State' is the last word of the
+# Status field.
+INDEX_FUNCS = {
+    'Source': source_name,
+    'State': lambda pkg: pkg['Status'].split()[-1]
+}
+
+
+def read_extended_states(path):
+    states = {}
+
+    with open(path, 'r', encoding='utf8') as f:
+        cur = None
+        lineno = 0
+
+        for line in f:
+            lineno += 1
+            line = line.strip()
+
+            if line.startswith('Package:'):
+                if cur is None:
+                    cur = {'Package': re.fullmatch(r'Package:\s+(\S.*)', line)[1]}
+                else:
+                    raise RuntimeError("%s:%s: Unexpected start of package description" % (path, lineno))
+
+            elif not line:
+                if not cur or any(k not in cur for k in EXTENDED_KEYS):
+                    raise RuntimeError("%s:%s: Incomplete package description" % (path, lineno))
+
+                if cur['Package'] in states:
+                    raise RuntimeError("%s:%s: Duplicate package description" % (path, lineno))
+
+                states[gen_pkg_key(cur)] = cur
+                cur = None
+
+            else:
+                m = re.fullmatch(r'([A-Za-z-]+):\s+(\S.*)', line)
+                if m[1] not in EXTENDED_KEYS:
+                    raise RuntimeError("%s:%s: Invalid key" % (path, lineno))
+
+                if m[1] in cur:
+                    raise RuntimeError("%s:%s: Duplicate key" % (path, lineno))
+
+                cur[m[1]] = m[2]
+
+    return states
+
+
+_FIELD_RES = {}
+
+def _field_re(key):
+    """
+    Regular expression which finds a field including its continuation lines
+    in a raw record.
+    """
+    r = _FIELD_RES.get(key)
+    if r is None:
+        r = re.compile(rb'^' + re.escape(key.encode('ascii')) +
+                rb':[ \t]*([^\n]*)((?:\n [^\n]*)*)', re.M)
+        _FIELD_RES[key] = r
+
+    return r
+
+
+class LazyPackage(collections.abc.Mapping):
+    """
+    A package record which references a region of the status file and
+    decodes fields only when they are accessed.
+    """
+    __slots__ = ('_buf', '_start', '_end', '_filename', '_fields', '_complete')
+
+    def __init__(self, buf, start, end, filename, package, arch):
+        self._buf = buf
+        self._start = start
+        self._end = end
+        self._filename = filename
+        self._fields = {'Package': package, 'Architecture': arch}
+        self._complete = False
+
+    def raw(self):
+        """
+        The raw bytes of this record
+        """
+        return bytes(self._buf[self._start:self._end])
+
+    def _lineno(self, offset=0):
+        """
+        Line number in the status file; only computed for error messages
+        """
+        return self._buf[:self._start].count(b'\n') + 1 + offset
+
+    def _decode_all(self):
+        fields = {}
+        last_kw = None
+
+        for i, line in enumerate(self.raw().decode('utf8').split('\n')):
+            if line.startswith(' '):
+                if not last_kw:
+                    raise InvalidLine(self._filename, self._lineno(i), "Expected keyword before continued line")
+
+                fields[last_kw] += "\n" + line[1:]
+
+            else:
+                m = re.fullmatch(r'([A-Za-z-]+):(?:\s+(\S.*)?)?', line)
+                if not m:
+                    raise InvalidLine(self._filename, self._lineno(i), "Expected k: v")
+
+                if m[1] not in AVAILABLE_KEYS:
+                    raise InvalidLine(self._filename, self._lineno(i), "Invalid key: '%s'" % m[1])
+
+                last_kw = m[1]
+                fields[m[1]] = m[2] or ''
+
+        for rk in REQUIRED_KEYS:
+            if rk not in fields:
+                raise InvalidLine(self._filename, self._lineno(i + 1), "Required key '%s' missing" % rk)
+
+        self._fields = fields
+        self._complete = True
+
+    def __getitem__(self, key):
+        try:
+            return self._fields[key]
+        except KeyError:
+            pass
+
+        if self._complete or key not in AVAILABLE_KEYS:
+            raise KeyError(key)
+
+        m = _field_re(key).search(self._buf, self._start, self._end)
+        if not m:
+            raise KeyError(key)
+
+        v = m[1].decode('utf8')
+        if m[2]:
+            v += m[2].replace(b'\n ', b'\n').decode('utf8')
+
+        self._fields[key] = v
+        return v
+
+    def __iter__(self):
+        if not self._complete:
+            self._decode_all()
+
+        return iter(self._fields)
+
+    def __len__(self):
+        if not self._complete:
+            self._decode_all()
+
+        return len(self._fields)
+
+    def __repr__(self):
+        return 'LazyPackage(%s:%s)' % (self._fields['Package'], self._fields['Architecture'])
+
+
+def format_record(pkg):
+    """
+    Raw status file record of a package dict, i.e. the inverse of parsing it
+    """
+    lines = []
+    for k, v in pkg.items():
+        first, *rest = v.split('\n')
+        lines.append('%s: %s' % (k, first) if first else '%s:' % k)
+        lines += [' ' + l for l in rest]
+
+    return '\n'.join(lines).encode('utf8')
+
+
+def index_status(buf, filename):
+    """
+    Find the records in the raw content of a status file. Only 'Package' and
+    'Architecture' are decoded, all other fields are decoded on access; the
+    presence of the other required keys is checked, though.
+
+    Returns a dict gen_pkg_key -> LazyPackage
+    """
+    status = {}
+    pkg_re = _field_re('Package')
+    arch_re = _field_re('Architecture')
+    other_res = [(rk, _field_re(rk)) for rk in REQUIRED_KEYS if rk not in ('Package', 'Architecture')]
+
+    size = len(buf)
+    pos = 0
+
+    while pos < size:
+        end = buf.find(b'\n\n', pos)
+        if end < 0:
+            end = size
+            if buf[end - 1:end] == b'\n':
+                end -= 1
+
+        if end == pos:
+            raise InvalidLine(filename, buf[:pos].count(b'\n') + 1, "Expected record")
+
+        m_pkg = pkg_re.search(buf, pos, end)
+        m_arch = arch_re.search(buf, pos, end)
+        if not m_pkg or not m_arch:
+            raise InvalidLine(filename, buf[:end].count(b'\n') + 1,
+                    "Required key '%s' missing" % ('Package' if not m_pkg else 'Architecture'))
+
+        for rk, r in other_res:
+            if not r.search(buf, pos, end):
+                raise InvalidLine(filename, buf[:end].count(b'\n') + 1,
+                        "Required key '%s' missing" % rk)
+
+        k = (m_pkg[1].decode('utf8'), m_arch[1].decode('utf8'))
+        if k in status:
+            raise InvalidLine(filename, buf[:end].count(b'\n') + 2, "Duplicate package record")
+
+        status[k] = LazyPackage(buf, pos, end, filename, k[0], k[1])
+        pos = end + 2
+
+    return status
+
+
 class DPKGDB:
-    def __init__(self, path):
+    def __init__(self, path, cache_dir=None):
+        """
+        :param path: dpkg status directory; may also be a status file, e.g. a
+            snapshot, in which case the info directory is not available.
+        :param cache_dir: If not None, keep a cache of the parsed status file
+            in this directory.
+        """
         self._path = path
+        self._cache_dir = cache_dir
         self._status = None
+        self._mmap = None
+        self._graph = None
+        self._sorted_keys = None
+        self._indexes = {}
 
-    def read_status(self):
+    def read_status(self, lazy=False):
         """
         Read status
+
+        :param lazy: Memory-map the status file and only index the records;
+            fields are decoded when accessed.
         """
-        status_path = os.path.join(self._path, 'status')
+        status_path = self._path
+        if os.path.isdir(status_path):
+            status_path = os.path.join(status_path, 'status')
+
+        self.close()
 
+        if self._cache_dir is not None:
+            identity = dpkg_cache.status_identity(status_path)
+            cache = dpkg_cache.open_cache(self._cache_dir, status_path, identity,
+                    lambda k, raw: LazyPackage(raw, 0, len(raw), status_path, k[0], k[1]))
+            if cache is not None:
+                self._status = cache
+                return
+
+        if lazy:
+            with open(status_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self._status = {}
+                else:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._status = index_status(self._mmap, status_path)
+
+        else:
+            self._read_status_eager(status_path)
+
+        if self._cache_dir is not None:
+            dpkg_cache.write_cache(self._cache_dir, status_path, identity,
+                    ((k, pkg.raw() if isinstance(pkg, LazyPackage) else format_record(pkg))
+                        for k, pkg in self._status.items()))
+
+    def _read_status_eager(self, status_path):
         self._status = {}
         cur_pkg = None
         last_kw = None
@@ -127,12 +407,163 @@ class DPKGDB:
                     cur_pkg[m[1]] = m[2] or ''
 
 
+    def dependency_graph(self):
+        """
+        Dependency graph of the present packages; built on first use
+        """
+        if self._graph is None:
+            self._graph = dpkg_deps.DependencyGraph(self)
+
+        return self._graph
+
+    def get_md5sums_path(self, pkg):
+        """
+        Path of the md5sums file of a package in dpkg's info directory or None
+        if the package has no md5sums file
+        """
+        info_dir = os.path.join(self._path, 'info')
+        p1 = os.path.join(info_dir, pkg['Package'] + '.md5sums')
+        p2 = os.path.join(info_dir, pkg['Package'] + ':' + pkg['Architecture'] + '.md5sums')
+        e1 = os.path.isfile(p1)
+        e2 = os.path.isfile(p2)
+
+        if e1 and e2:
+            raise RuntimeError("md5sums db contradiction")
+
+        return p1 if e1 else (p2 if e2 else None)
+
+    def close(self):
+        """
+        Release the package table. The memory-mapped status file of a lazily
+        read database is released once no package references it anymore.
+        """
+        self._status = None
+        self._mmap = None
+        self._graph = None
+        self._sorted_keys = None
+        self._indexes = {}
+
+    def raw(self, key):
+        """
+        Raw bytes of a package record or None if the database was read
+        eagerly
+        """
+        pkg = self._status[key]
+        return pkg.raw() if isinstance(pkg, LazyPackage) else None
+
+    def keys(self):
+        """
+        Sorted list of the keys of all packages
+        """
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._status)
+
+        return self._sorted_keys
+
+    def index(self, field):
+        """
+        Secondary index on a field, built on first use.
+
+        Returns (dict value -> list of keys, sorted list of values). Packages
+        without the field are not contained.
+        """
+        idx = self._indexes.get(field)
+        if idx is None:
+            func = INDEX_FUNCS.get(field)
+            values = {}
+
+            for k in self.keys():
+                pkg = self._status[k]
+                if func:
+                    v = func(pkg)
+                elif field in pkg:
+                    v = pkg[field]
+                else:
+                    continue
+
+                l = values.get(v)
+                if l is None:
+                    values[v] = [k]
+                else:
+                    l.append(k)
+
+            idx = (values, sorted(values))
+            self._indexes[field] = idx
+
+        return idx
+
+    def _query_keys(self, field, op, arg):
+        values, sorted_values = self.index(field)
+
+        if op == '=':
+            return values.get(arg, [])
+
+        elif op == 'in':
+            return [k for v in arg for k in values.get(v, [])]
+
+        elif op == 'prefix':
+            keys = []
+            for i in range(bisect.bisect_left(sorted_values, arg), len(sorted_values)):
+                if not sorted_values[i].startswith(arg):
+                    break
+
+                keys += values[sorted_values[i]]
+
+            return keys
+
+        raise ValueError("Invalid query operator: '%s'" % op)
+
+    def query(self, *conditions):
+        """
+        Find packages using the secondary indexes.
+
+        :param conditions: Tuples (field, op, arg) which must all match; op is
+            '=' (equality), 'prefix' (arg is a prefix of the value) or 'in'
+            (value is in the set arg). 'Source' matches source package names
+            and 'State' the package state, e.g. ('State', '=', 'half-configured').
+
+        Returns a list of packages sorted by key
+        """
+        keys = None
+        for field, op, arg in conditions:
+            ks = self._query_keys(field, op, arg)
+            keys = set(ks) if keys is None else keys.intersection(ks)
+
+            if not keys:
+                return []
+
+        if keys is None:
+            return list(self)
+
+        return [self._status[k] for k in sorted(keys)]
+
+    def __getitem__(self, key):
+        return self._status[key]
+
+    def __contains__(self, key):
+        return key in self._status
+
+    def __len__(self):
+        return len(self._status)
+
     def __iter__(self):
-        for k in sorted(self._status):
+        for k in self.keys():
             yield(self._status[k])
 
 
 #********************************** Exceptions ********************************
-class InvalidLine(Exception):
+class InvalidStatusFile(Exception):
+    pass
+
+
+class InvalidLine(InvalidStatusFile):
     def __init__(self, filename, lineno, msg='?'):
         super().__init__("Invalid line in %s:%d: %s" % (filename, lineno, msg))
+
+        self.filename = filename
+        self.lineno = lineno
+        self.msg = msg
+
+    def __reduce__(self):
+        # Raised in worker processes, e.g. by dpkg_fleet
+        return (InvalidLine, (self.filename, self.lineno, self.msg))
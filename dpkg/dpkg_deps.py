@@ -0,0 +1,316 @@
+"""
+Dependency graph of the packages in a dpkg database
+"""
+import array
+import collections
+import re
+
+
+DEP_FIELDS = ('Pre-Depends', 'Depends', 'Recommends', 'Suggests')
+
+# Relationships which keep a package installed. This mirrors apt's defaults
+# APT::AutoRemove::RecommendsImportant and SuggestsImportant.
+AUTOREMOVE_FIELDS = DEP_FIELDS
+
+# Package states in which a package does not satisfy dependencies
+NOT_PRESENT_STATES = {'not-installed', 'config-files'}
+
+
+#******************************** Versions ************************************
+def _order(c):
+    if not c:
+        return 0
+    if c.isalpha():
+        return ord(c)
+    if c == '~':
+        return -1
+
+    return ord(c) + 256
+
+
+def _verrevcmp(a, b):
+    i = 0
+    j = 0
+
+    while i < len(a) or j < len(b):
+        first_diff = 0
+
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i] if i < len(a) and not a[i].isdigit() else '')
+            bc = _order(b[j] if j < len(b) and not b[j].isdigit() else '')
+            if ac != bc:
+                return ac - bc
+
+            i += 1
+            j += 1
+
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+
+    return 0
+
+
+def _split_version(v):
+    epoch, sep, rest = v.partition(':')
+    if not sep:
+        epoch, rest = '0', v
+
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = rest, ''
+
+    return (int(epoch), upstream, revision)
+
+
+def compare_versions(a, b):
+    """
+    Compare two Debian version strings like dpkg does.
+
+    Returns < 0, 0 or > 0
+    """
+    ea, ua, ra = _split_version(a)
+    eb, ub, rb = _split_version(b)
+
+    if ea != eb:
+        return ea - eb
+
+    return _verrevcmp(ua, ub) or _verrevcmp(ra, rb)
+
+
+def version_satisfies(have, op, want):
+    c = compare_versions(have, want)
+    return {
+        '<<': c < 0,
+        '<=': c <= 0,
+        '<': c <= 0,
+        '=': c == 0,
+        '>=': c >= 0,
+        '>': c >= 0,
+        '>>': c > 0
+    }[op]
+
+
+#******************************* Relationships ********************************
+Relation = collections.namedtuple('Relation', ('name', 'arch', 'op', 'version'))
+
+_RELATION_RE = re.compile(
+        r'\s*([A-Za-z0-9][A-Za-z0-9+.-]*)(?::([A-Za-z0-9-]+))?\s*'
+        r'(?:\(\s*(<<|<=|=|>=|>>|<|>)\s*([^)\s]+)\s*\))?\s*'
+        r'(?:\[[^\]]*\])?\s*(?:<[^>]*>\s*)*')
+
+
+def parse_relations(s):
+    """
+    Parse a relationship field like 'Depends'.
+
+    Returns a list of alternatives, each a list of Relation tuples
+    """
+    rels = []
+    for group in s.split(','):
+        if not group.strip():
+            continue
+
+        alts = []
+        for alt in group.split('|'):
+            m = _RELATION_RE.fullmatch(alt)
+            if not m:
+                raise ValueError("Invalid relationship: '%s'" % alt.strip())
+
+            alts.append(Relation(m[1], m[2], m[3], m[4]))
+
+        rels.append(alts)
+
+    return rels
+
+
+#********************************** Graph *************************************
+class DependencyGraph:
+    """
+    Dependency graph of the present packages of a DPKGDB. Packages are
+    identified by integer ids; the edges of each relationship field are stored
+    in compressed sparse row form, forward and reverse. An edge leads to every
+    present package which satisfies any alternative of a relationship,
+    including packages which provide a virtual package.
+    """
+    def __init__(self, db, fields=DEP_FIELDS):
+        self.keys = []
+        self._ids = {}
+        self._pkgs = []
+        self._by_name = collections.defaultdict(list)
+        self._provides = collections.defaultdict(list)
+
+        for pkg in db:
+            if pkg['Status'].split()[-1] in NOT_PRESENT_STATES:
+                continue
+
+            i = len(self.keys)
+            key = (pkg['Package'], pkg['Architecture'])
+            self.keys.append(key)
+            self._ids[key] = i
+            self._pkgs.append((pkg['Architecture'], pkg['Version'], pkg.get('Multi-Arch', 'no')))
+            self._by_name[pkg['Package']].append(i)
+
+            for alts in parse_relations(pkg.get('Provides', '')):
+                for r in alts:
+                    self._provides[r.name].append((i, r.version if r.op == '=' else None))
+
+        self._forward = {}
+        self._reverse = {}
+
+        targets = {field: [[] for _ in self.keys] for field in fields}
+        for pkg in db:
+            i = self._ids.get((pkg['Package'], pkg['Architecture']))
+            if i is None:
+                continue
+
+            for field in fields:
+                if field not in pkg:
+                    continue
+
+                t = set()
+                for alts in parse_relations(pkg[field]):
+                    for r in alts:
+                        t.update(self._resolve(i, r))
+
+                t.discard(i)
+                targets[field][i] = sorted(t)
+
+        for field in fields:
+            sources = [[] for _ in self.keys]
+            for i, t in enumerate(targets[field]):
+                for j in t:
+                    sources[j].append(i)
+
+            self._forward[field] = self._csr(targets[field])
+            self._reverse[field] = self._csr(sources)
+
+    @staticmethod
+    def _csr(adj):
+        offsets = array.array('I', [0])
+        edges = array.array('I')
+        for l in adj:
+            edges.extend(l)
+            offsets.append(len(edges))
+
+        return (offsets, edges)
+
+    def _arch_matches(self, src, dst, qualifier):
+        src_arch = self._pkgs[src][0]
+        dst_arch, _, multi_arch = self._pkgs[dst]
+
+        if qualifier == 'any':
+            return multi_arch in ('allowed', 'foreign') or dst_arch in (src_arch, 'all')
+
+        if qualifier and qualifier != 'native':
+            return dst_arch == qualifier
+
+        return src_arch == 'all' or dst_arch in (src_arch, 'all') or multi_arch == 'foreign'
+
+    def _resolve(self, src, r):
+        """
+        Ids of the packages which satisfy a relation
+        """
+        for i in self._by_name.get(r.name, ()):
+            if self._arch_matches(src, i, r.arch) and \
+                    (r.op is None or version_satisfies(self._pkgs[i][1], r.op, r.version)):
+                yield i
+
+        for i, version in self._provides.get(r.name, ()):
+            if self._arch_matches(src, i, r.arch) and \
+                    (r.op is None or (version is not None and version_satisfies(version, r.op, r.version))):
+                yield i
+
+    def _ids_of(self, pkgs):
+        """
+        Ids of packages given as (Package, Architecture) keys or as names
+        """
+        if isinstance(pkgs, (str, tuple)):
+            pkgs = [pkgs]
+
+        ids = []
+        for p in pkgs:
+            if isinstance(p, str):
+                ids += self._by_name.get(p, [])
+            elif p in self._ids:
+                ids.append(self._ids[p])
+
+        return ids
+
+    def _neighbours(self, i, fields, reverse):
+        adj = self._reverse if reverse else self._forward
+        for field in fields:
+            offsets, edges = adj[field]
+            yield from edges[offsets[i]:offsets[i + 1]]
+
+    def _reachable(self, ids, fields, reverse):
+        seen = set(ids)
+        todo = list(ids)
+
+        while todo:
+            i = todo.pop()
+            for j in self._neighbours(i, fields, reverse):
+                if j not in seen:
+                    seen.add(j)
+                    todo.append(j)
+
+        return seen
+
+    def depends(self, pkgs, fields=DEP_FIELDS):
+        """
+        Packages which the given packages (keys or names) depend on directly
+        """
+        return sorted({self.keys[j] for i in self._ids_of(pkgs)
+                for j in self._neighbours(i, fields, False)})
+
+    def rdepends(self, pkgs, fields=DEP_FIELDS):
+        """
+        Packages which depend directly on the given packages (keys or names)
+        """
+        return sorted({self.keys[j] for i in self._ids_of(pkgs)
+                for j in self._neighbours(i, fields, True)})
+
+    def closure(self, pkgs, fields=DEP_FIELDS, reverse=False):
+        """
+        Transitive closure of the dependencies of the given packages (keys or
+        names), including the packages themselves. With reverse=True, all
+        packages which pull in the given packages.
+        """
+        return sorted(self.keys[i] for i in self._reachable(self._ids_of(pkgs), fields, reverse))
+
+    def orphans(self, db, extended_states, default_arch, fields=AUTOREMOVE_FIELDS):
+        """
+        Automatically installed packages which are not required by any
+        manually installed, essential, important or protected package, like
+        'apt autoremove' would determine them.
+
+        :param extended_states: As returned by dpkg_db.read_extended_states
+        :param default_arch: Architecture under which arch:all packages are
+            listed in extended_states
+        """
+        roots = []
+        for i, key in enumerate(self.keys):
+            pkg = db[key]
+            ext_key = (key[0], default_arch) if key[1] == 'all' else key
+
+            if ext_key not in extended_states or \
+                    extended_states[ext_key]['Auto-Installed'] != '1' or \
+                    any(pkg.get(f) == 'yes' for f in ('Essential', 'Important', 'Protected')):
+                roots.append(i)
+
+        required = self._reachable(roots, fields, False)
+        return sorted(self.keys[i] for i in range(len(self.keys)) if i not in required)
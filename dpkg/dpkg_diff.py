@@ -0,0 +1,83 @@
+"""
+Differences between two dpkg status databases
+"""
+import dpkg_deps
+
+
+def diff_packages(pkg1, pkg2):
+    """
+    Field-level differences of two package records.
+
+    Returns a dict field -> (old value or None, new value or None)
+    """
+    changes = {}
+    for f in sorted(set(pkg1) | set(pkg2)):
+        v1 = pkg1.get(f)
+        v2 = pkg2.get(f)
+        if v1 != v2:
+            changes[f] = (v1, v2)
+
+    return changes
+
+
+def diff_status(db1, db2, fields=True):
+    """
+    Compare two DPKGDB instances in a single merged pass over their sorted
+    keys. If both databases were read lazily, records with identical raw bytes
+    are skipped without decoding them.
+
+    :param fields: Include field-level changes in 'changed' entries
+
+    Yields dicts with the keys 'change' ('added', 'removed' or 'changed'),
+    'package', 'architecture' and further information about the change
+    """
+    keys1 = db1.keys()
+    keys2 = db2.keys()
+    i = 0
+    j = 0
+
+    while i < len(keys1) or j < len(keys2):
+        k1 = keys1[i] if i < len(keys1) else None
+        k2 = keys2[j] if j < len(keys2) else None
+
+        if k2 is None or (k1 is not None and k1 < k2):
+            pkg = db1[k1]
+            yield {'change': 'removed', 'package': k1[0], 'architecture': k1[1],
+                    'version': pkg['Version'], 'status': pkg['Status']}
+            i += 1
+            continue
+
+        if k1 is None or k2 < k1:
+            pkg = db2[k2]
+            yield {'change': 'added', 'package': k2[0], 'architecture': k2[1],
+                    'version': pkg['Version'], 'status': pkg['Status']}
+            j += 1
+            continue
+
+        i += 1
+        j += 1
+
+        raw1 = db1.raw(k1)
+        if raw1 is not None and raw1 == db2.raw(k2):
+            continue
+
+        pkg1 = db1[k1]
+        pkg2 = db2[k2]
+        changes = diff_packages(pkg1, pkg2)
+        if not changes:
+            continue
+
+        d = {'change': 'changed', 'package': k1[0], 'architecture': k1[1]}
+
+        if 'Version' in changes:
+            c = dpkg_deps.compare_versions(pkg1['Version'], pkg2['Version'])
+            d['version'] = changes['Version']
+            d['version_change'] = 'upgrade' if c < 0 else ('downgrade' if c > 0 else 'same')
+
+        if 'Status' in changes:
+            d['status'] = changes['Status']
+
+        if fields:
+            d['fields'] = changes
+
+        yield d
@@ -0,0 +1,161 @@
+"""
+Package index over the dpkg status databases of many hosts
+"""
+import collections
+import concurrent.futures
+import os
+import sys
+import tarfile
+import dpkg_db
+import dpkg_deps
+
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2')
+
+# Trailing path components which are dropped when deriving a host name from
+# the location of a status file
+STATUS_DIR_SUFFIX = ('var', 'lib', 'dpkg')
+
+
+def host_name(path):
+    """
+    Derive a host name from the location of a status directory relative to
+    the top of the archive tree
+    """
+    parts = [p for p in path.split('/') if p and p != '.']
+    if tuple(parts[-len(STATUS_DIR_SUFFIX):]) == STATUS_DIR_SUFFIX:
+        parts = parts[:-len(STATUS_DIR_SUFFIX)]
+
+    return '/'.join(parts) or '.'
+
+
+def _strip_tar_suffix(name):
+    for s in TAR_SUFFIXES:
+        if name.endswith(s):
+            return name[:-len(s)]
+
+    return name
+
+
+def discover_sources(top):
+    """
+    Find dpkg status directories (directories containing a 'status' file) and
+    tarballs below top.
+
+    Returns a list of ('dir', path, host) and ('tar', path, host prefix)
+    """
+    sources = []
+
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, top)
+
+        if 'status' in filenames:
+            sources.append(('dir', dirpath, host_name(rel)))
+
+        for f in sorted(filenames):
+            if f.endswith(TAR_SUFFIXES):
+                sources.append(('tar', os.path.join(dirpath, f),
+                    _strip_tar_suffix(os.path.normpath(os.path.join(rel, f)))))
+
+    return sources
+
+
+def _summarize(pkgs):
+    """
+    (Package, Architecture, Version) of all present packages
+    """
+    return [(pkg['Package'], pkg['Architecture'], pkg['Version'])
+            for pkg in pkgs
+            if pkg['Status'].split()[-1] not in dpkg_deps.NOT_PRESENT_STATES]
+
+
+def read_source(kind, path, host):
+    """
+    Read the packages of one source. Suitable to run in a worker process.
+
+    Returns a list of (host, list of (Package, Architecture, Version))
+    """
+    if kind == 'dir':
+        db = dpkg_db.DPKGDB(path)
+        db.read_status(lazy=True)
+        return [(host, _summarize(db))]
+
+    results = []
+    with tarfile.open(path, 'r:*') as tf:
+        for m in tf:
+            if not m.isreg() or os.path.basename(m.name) != 'status':
+                continue
+
+            data = tf.extractfile(m).read()
+            status = dpkg_db.index_status(data, '%s:%s' % (path, m.name))
+            inner = host_name(os.path.dirname(m.name))
+            results.append((host if inner == '.' else host + '/' + inner, _summarize(status.values())))
+
+    return results
+
+
+class FleetIndex:
+    """
+    Index package -> version -> hosts. Names, versions and hosts are interned
+    so that each distinct string is stored only once. Hosts (or host prefixes
+    of tarballs) whose source could not be read are kept in failed with the
+    error.
+    """
+    def __init__(self):
+        self.packages = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.hosts = set()
+        self.failed = {}
+
+    def add(self, host, pkgs):
+        host = sys.intern(host)
+        self.hosts.add(host)
+
+        for name, arch, version in pkgs:
+            self.packages[sys.intern(name)][sys.intern(version)].add(host)
+
+    def hosts_with(self, package, version=None, before=None):
+        """
+        Hosts which have a package installed, optionally in a specific version
+        or a version older than before
+        """
+        hosts = set()
+        for v, hs in self.packages.get(package, {}).items():
+            if (version is None or v == version) and \
+                    (before is None or dpkg_deps.compare_versions(v, before) < 0):
+                hosts |= hs
+
+        return sorted(hosts)
+
+    def to_dict(self):
+        return {p: {v: sorted(hs) for v, hs in sorted(vs.items())}
+                for p, vs in sorted(self.packages.items())}
+
+
+def build_index(sources, jobs=None, log_output=sys.stderr):
+    """
+    Read all sources in a process pool and merge them into a FleetIndex. A
+    source which cannot be read is recorded as failed and does not abort the
+    run.
+    """
+    index = FleetIndex()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(read_source, *s): s for s in sources}
+
+        for fut in concurrent.futures.as_completed(futures):
+            kind, path, host = futures[fut]
+            try:
+                results = fut.result()
+
+            # Anything may be wrong with a status file of another host, e.g.
+            # dpkg_db.InvalidStatusFile or a KeyError of a missing field
+            except Exception as e:
+                print("Failed to read '%s': %s" % (path, e), file=log_output)
+                index.failed[host] = str(e)
+                continue
+
+            for host, pkgs in results:
+                index.add(host, pkgs)
+
+    return index
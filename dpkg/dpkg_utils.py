@@ -1,9 +1,25 @@
+import collections
+import concurrent.futures
+import hashlib
+import lzma
+import os
 import subprocess
+import tarfile
+import zlib
+
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def gen_pkg_spec(pkg):
+    return pkg['Package'] + ':' + pkg['Architecture'] + '=' + pkg['Version']
 
 
 def download(pkg, dst):
     res = subprocess.run([
-            'apt-get', 'download', pkg['Package'] + ':' + pkg['Architecture'] + '=' + pkg['Version']
+            'apt-get', 'download', gen_pkg_spec(pkg)
         ],
         cwd=dst,
         stdout=subprocess.PIPE,
@@ -16,6 +32,116 @@ def download(pkg, dst):
     return ''
 
 
+def apt_get_fetcher(pkgs, dst):
+    """
+    Download several packages with a single apt-get invocation.
+
+    Returns None on success or an error message
+    """
+    res = subprocess.run([
+            'apt-get', 'download', *(gen_pkg_spec(pkg) for pkg in pkgs)
+        ],
+        cwd=dst,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    if res.returncode != 0:
+        return res.stdout.decode('utf8') + ' ' + res.stderr.decode('utf8')
+
+    return None
+
+
+def _download_batch(pkgs, dst, fetcher):
+    msg = fetcher(pkgs, dst)
+
+    results = []
+    missing = []
+    for pkg in pkgs:
+        if os.path.isfile(os.path.join(dst, gen_deb_filename(pkg))):
+            results.append((pkg, None))
+        else:
+            missing.append(pkg)
+
+    # apt-get fails the entire batch if a single package is not available,
+    # hence retry the missing packages one by one to find the culprit.
+    if missing and len(pkgs) > 1:
+        for pkg in missing:
+            results += _download_batch([pkg], dst, fetcher)
+
+    else:
+        for pkg in missing:
+            results.append((pkg, DownloadFailed(pkg, msg or "No .deb file after download")))
+
+    return results
+
+
+def download_many(pkgs, dst, jobs=4, batch_size=16, fetcher=apt_get_fetcher):
+    """
+    Download many packages concurrently. Packages are grouped into batches of
+    at most batch_size packages, of which up to jobs are fetched in parallel.
+
+    :param fetcher: Callable fetcher(pkgs, dst) that downloads the .deb files
+        of the given packages to dst and returns None or an error message.
+
+    Yields (pkg, None) or (pkg, DownloadFailed) as soon as a batch completes
+    """
+    pkgs = list(pkgs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_download_batch, pkgs[i:i + batch_size], dst, fetcher)
+                for i in range(0, len(pkgs), batch_size)]
+
+        for fut in concurrent.futures.as_completed(futures):
+            yield from fut.result()
+
+
+# Identical copy of pool_utils.bounded_map of the top directory since the
+# dpkg tools only import modules from their own directory
+def bounded_map(executor, tasks, window):
+    """
+    Run tasks on an executor with at most window futures queued at a time,
+    so that the remaining tasks wait in a compact form and are only created
+    as needed. Yields the results in the order of completion; pending futures
+    are cancelled if the caller stops early or an exception is raised.
+
+    :param tasks: Iterable of (function, args). A collections.deque is
+        consumed from the left, hence further tasks may be appended to it
+        while the results are processed.
+    """
+    if isinstance(tasks, collections.deque):
+        def _next():
+            return tasks.popleft() if tasks else None
+    else:
+        it = iter(tasks)
+
+        def _next():
+            return next(it, None)
+
+    pending = set()
+    try:
+        while True:
+            while len(pending) < window:
+                task = _next()
+                if task is None:
+                    break
+
+                func, args = task
+                pending.add(executor.submit(func, *args))
+
+            if not pending:
+                return
+
+            done, pending = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for fut in done:
+                yield fut.result()
+
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
 def gen_deb_filename(pkg):
     def _work_char(c):
         return {
@@ -29,6 +155,196 @@ def gen_deb_filename(pkg):
             '_' + pkg['Architecture'] + '.deb'
 
 
+class _ArMemberReader:
+    """
+    File-like object which reads the content of one ar member
+    """
+    def __init__(self, f, size):
+        self._f = f
+        self._remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self._remaining:
+            n = self._remaining
+
+        data = self._f.read(n)
+        self._remaining -= len(data)
+        return data
+
+    def skip(self):
+        while self._remaining > 0:
+            if not self.read(HASH_CHUNK_SIZE):
+                raise InvalidDeb(getattr(self._f, 'name', '?'), "Truncated ar member")
+
+
+def iter_ar_members(f):
+    """
+    Iterate over the members of an ar archive (a .deb file) without extracting
+    it. Yields (name, reader) tuples; a member which was not read completely is
+    skipped when the next member is requested.
+    """
+    filename = getattr(f, 'name', '?')
+
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise InvalidDeb(filename, "Not an ar archive")
+
+    while True:
+        hdr = f.read(AR_HEADER_SIZE)
+        if not hdr:
+            return
+
+        if len(hdr) != AR_HEADER_SIZE or hdr[58:60] != b'`\n':
+            raise InvalidDeb(filename, "Invalid ar member header")
+
+        try:
+            name = hdr[0:16].decode('ascii').rstrip(' ').rstrip('/')
+            size = int(hdr[48:58].decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            raise InvalidDeb(filename, "Invalid ar member header")
+
+        if size < 0:
+            raise InvalidDeb(filename, "Invalid ar member header")
+
+        reader = _ArMemberReader(f, size)
+        yield (name, reader)
+        reader.skip()
+
+        # Members are aligned to 2 bytes
+        if size % 2:
+            f.read(1)
+
+
+def parse_md5sums(text):
+    """
+    Parse the content of a md5sums file into a dict path -> md5 hexdigest.
+    Raises ValueError on malformed lines.
+    """
+    sums = {}
+    for line in text.splitlines():
+        if not line:
+            continue
+
+        try:
+            h, path = line.split(None, 1)
+        except ValueError:
+            raise ValueError("Invalid md5sums line: %r" % line)
+
+        sums[path.lstrip('/')] = h
+
+    return sums
+
+
+def _normalize_tar_name(name):
+    if name.startswith('./'):
+        name = name[2:]
+
+    return name.lstrip('/')
+
+
+class _HashingReader:
+    """
+    File-like object which computes the SHA-256 of all data read through it
+    """
+    def __init__(self, f):
+        self._f = f
+        self.name = getattr(f, 'name', '?')
+        self.sha256 = hashlib.sha256()
+
+    def read(self, n=-1):
+        data = self._f.read(n)
+        self.sha256.update(data)
+        return data
+
+    def drain(self):
+        while self.read(HASH_CHUNK_SIZE):
+            pass
+
+
+def read_deb_md5sums(filename):
+    """
+    Read the md5sums of a .deb file by streaming its members. If the package
+    does not contain a md5sums file, the md5sums are computed from the data
+    archive while it is read. The SHA-256 of the .deb file is computed in the
+    same pass.
+
+    Returns (md5sums dict path -> hexdigest, computed: bool, sha256 hexdigest)
+    """
+    with open(filename, 'rb') as raw:
+        f = _HashingReader(raw)
+        result = None
+
+        for name, reader in iter_ar_members(f):
+            if name.startswith('control.tar'):
+                with tarfile.open(fileobj=reader, mode='r|*') as tf:
+                    for m in tf:
+                        if m.isreg() and _normalize_tar_name(m.name) == 'md5sums':
+                            try:
+                                text = tf.extractfile(m).read().decode('utf8')
+                                result = (parse_md5sums(text), False)
+                            except (UnicodeDecodeError, ValueError) as e:
+                                raise InvalidDeb(filename, "Invalid md5sums file: %s" % e)
+                            break
+
+            elif name.startswith('data.tar'):
+                sums = {}
+                with tarfile.open(fileobj=reader, mode='r|*') as tf:
+                    for m in tf:
+                        path = _normalize_tar_name(m.name)
+
+                        if m.isreg():
+                            h = hashlib.md5()
+                            content = tf.extractfile(m)
+                            while True:
+                                c = content.read(HASH_CHUNK_SIZE)
+                                if not c:
+                                    break
+                                h.update(c)
+
+                            sums[path] = h.hexdigest()
+
+                        # Hardlinks are regular files once unpacked
+                        elif m.islnk():
+                            target = _normalize_tar_name(m.linkname)
+                            if target in sums:
+                                sums[path] = sums[target]
+
+                result = (sums, True)
+
+            if result is not None:
+                break
+
+        if result is None:
+            raise InvalidDeb(filename, "No data archive")
+
+        f.drain()
+        return result + (f.sha256.hexdigest(),)
+
+
+def verify_deb(deb_filename, md5sums_path):
+    """
+    Compare the md5sums of a .deb file with a md5sums file from dpkg's
+    database. Suitable to run in a worker process.
+
+    Returns (error message or None, md5sums were computed: bool, SHA-256 of
+    the .deb file or None if it could not be read)
+    """
+    try:
+        ref, computed, sha256 = read_deb_md5sums(deb_filename)
+    except (InvalidDeb, tarfile.TarError, OSError, EOFError, lzma.LZMAError, zlib.error) as e:
+        return (str(e), False, None)
+
+    if md5sums_path is None:
+        return ("md5sum missmatch", computed, sha256)
+
+    try:
+        with open(md5sums_path, 'r', encoding='utf8') as f:
+            real = parse_md5sums(f.read())
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        return ("Cannot read %s: %s" % (md5sums_path, e), computed, sha256)
+
+    return (None if ref == real else "md5sum missmatch", computed, sha256)
+
+
 #********************************** Exceptions ********************************
 class DownloadFailed(Exception):
     def __init__(self, pkg, msg):
@@ -37,3 +353,7 @@ class DownloadFailed(Exception):
 
         self.pkg = pkg
         self.msg = msg
+
+class InvalidDeb(Exception):
+    def __init__(self, filename, msg):
+        super().__init__("Invalid .deb file %s: %s" % (filename, msg))
@@ -0,0 +1,136 @@
+"""
+Check the installed files of packages against the md5sums files in dpkg's
+database
+"""
+import collections
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import stat
+import dpkg_utils
+
+
+READ_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Package states in which a package has no files on disk
+NO_FILES_STATES = {'not-installed', 'config-files'}
+
+
+def collect_installed_md5sums(db):
+    """
+    Read the md5sums files of all packages which have files on disk. A path
+    may be listed by multiple packages (e.g. by multiple architectures of a
+    Multi-Arch: same package).
+
+    Returns a dict path -> (set of valid md5 hexdigests, list of owners)
+    """
+    paths = {}
+
+    for pkg in db:
+        if pkg['Status'].split()[-1] in NO_FILES_STATES:
+            continue
+
+        md5sums_path = db.get_md5sums_path(pkg)
+        if md5sums_path is None:
+            continue
+
+        owner = '%s:%s' % (pkg['Package'], pkg['Architecture'])
+
+        # Paths are bytes on disk; keep the ones which are not valid UTF-8
+        with open(md5sums_path, 'r', encoding='utf8', errors='surrogateescape') as f:
+            sums = dpkg_utils.parse_md5sums(f.read())
+
+        for path, h in sums.items():
+            entry = paths.get(path)
+            if entry is None:
+                paths[path] = ({h}, [owner])
+            else:
+                entry[0].add(h)
+                entry[1].append(owner)
+
+    return paths
+
+
+def hash_file(path, size):
+    """
+    md5 hexdigest of a file. Large files are hashed from a memory map.
+    """
+    h = hashlib.md5()
+
+    with open(path, 'rb') as f:
+        m = None
+        if size >= MMAP_THRESHOLD:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # The file was truncated since it was stat'ed or cannot be
+                # mapped
+                pass
+
+        if m is not None:
+            with m:
+                m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+
+        else:
+            while True:
+                c = f.read(READ_SIZE)
+                if not c:
+                    break
+                h.update(c)
+
+    return h.hexdigest()
+
+
+Mismatch = collections.namedtuple('Mismatch', ('path', 'reason', 'expected', 'actual', 'owners'))
+
+
+def _check(path, size, expected, owners):
+    try:
+        actual = hash_file(path, size)
+    except FileNotFoundError:
+        return Mismatch(path, 'missing', expected, None, owners)
+    except OSError as e:
+        return Mismatch(path, 'error: %s' % e.strerror, expected, None, owners)
+
+    if actual not in expected:
+        return Mismatch(path, 'content', expected, actual, owners)
+
+    return None
+
+
+def check_installed_files(paths, root='/', workers=8):
+    """
+    Hash the installed files with a thread pool. Files are processed in the
+    order of (device, inode) to reduce seeks.
+
+    :param paths: dict path -> (expected md5s, owners) as returned by
+        collect_installed_md5sums.
+
+    Yields Mismatch tuples as they are found
+    """
+    todo = []
+    for path, (expected, owners) in paths.items():
+        fs_path = os.path.join(root, path)
+
+        try:
+            s = os.stat(fs_path)
+        except FileNotFoundError:
+            yield Mismatch(fs_path, 'missing', expected, None, owners)
+            continue
+
+        if not stat.S_ISREG(s.st_mode):
+            yield Mismatch(fs_path, 'not a regular file', expected, None, owners)
+            continue
+
+        todo.append((s.st_dev, s.st_ino, fs_path, s.st_size, expected, owners))
+
+    todo.sort(key=lambda t: (t[0], t[1]))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for m in dpkg_utils.bounded_map(executor,
+                ((_check, t[2:]) for t in todo), 4 * workers):
+            if m is not None:
+                yield m
@@ -0,0 +1,122 @@
+"""
+Persistent record of md5sums verification results
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+
+COMMIT_INTERVAL = 100
+
+
+def file_identity(path):
+    """
+    Identity of a file or None if it does not exist
+    """
+    try:
+        s = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return '%d:%d:%d' % (s.st_ino, s.st_size, s.st_mtime_ns)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            c = f.read(1024 * 1024)
+            if not c:
+                break
+            h.update(c)
+
+    return h.hexdigest()
+
+
+class VerifyLedger:
+    """
+    Verification results keyed by (Package, Architecture, Version), together
+    with the .deb file and the md5sums file they were obtained from.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                'package TEXT, architecture TEXT, version TEXT, '
+                'deb_identity TEXT, deb_sha256 TEXT, md5sums_identity TEXT, '
+                'error TEXT, computed INTEGER, verified_at REAL, '
+                'PRIMARY KEY (package, architecture, version)) WITHOUT ROWID')
+
+        self._uncommitted = 0
+
+    def _key(self, pkg):
+        return (pkg['Package'], pkg['Architecture'], pkg['Version'])
+
+    def is_fresh(self, pkg, deb_filename, md5sums_path, max_age=None):
+        """
+        Check if a package was verified successfully before and neither its
+        version, its .deb file nor its md5sums file changed since. A .deb
+        file which is not present anymore is not considered a change.
+
+        :param max_age: Maximum age of the last verification in seconds
+        """
+        row = self._conn.execute('SELECT deb_identity, deb_sha256, md5sums_identity, error, verified_at '
+                'FROM entries WHERE package = ? AND architecture = ? AND version = ?',
+                self._key(pkg)).fetchone()
+
+        if row is None:
+            return False
+
+        deb_identity, deb_sha256, md5sums_identity, error, verified_at = row
+
+        if error is not None:
+            return False
+
+        if max_age is not None and time.time() - verified_at > max_age:
+            return False
+
+        if (file_identity(md5sums_path) if md5sums_path else None) != md5sums_identity:
+            return False
+
+        cur_deb_identity = file_identity(deb_filename)
+        if cur_deb_identity is not None and cur_deb_identity != deb_identity:
+            # E.g. downloaded again; only the content matters
+            if file_sha256(deb_filename) != deb_sha256:
+                return False
+
+            self._conn.execute('UPDATE entries SET deb_identity = ? '
+                    'WHERE package = ? AND architecture = ? AND version = ?',
+                    (cur_deb_identity, *self._key(pkg)))
+            self._changed()
+
+        return True
+
+    def record(self, pkg, deb_filename, md5sums_path, error, computed, deb_sha256):
+        """
+        Record the result of a verification
+
+        :param deb_sha256: SHA-256 of the .deb file as computed while verifying
+            it or None if it could not be read
+        """
+        self._conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            *self._key(pkg),
+            file_identity(deb_filename),
+            deb_sha256,
+            file_identity(md5sums_path) if md5sums_path else None,
+            None if error is None else str(error),
+            int(computed),
+            time.time()))
+
+        self._changed()
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
@@ -1,62 +1,347 @@
 #!/usr/bin/python3
 import argparse
+import collections
+import concurrent.futures
+import io
+import lzma
 import os
-import re
+import pickle
 import stat
 import sys
+import zipfile
+import zlib
+import pool_utils
 
 
-# Fullmatch-regular expressions
-RULES = [
-    r'.*\.class',
-    r'.*\.jar',
-    r'.*\.jpi',
-    r'.*\.hpi',
-    r'.*\.war',
-    r'.*\.ear',
-    r'.*\.aar',
+# File name suffixes of java files
+SUFFIXES = (
+    '.class',
+    '.jar',
+    '.jpi',
+    '.hpi',
+    '.war',
+    '.ear',
+    '.aar',
 
     # NOTE: Not sure if .zip files can actually be used automatically by java
     # without 'exploding' them first
-    r'.*\.zip'
-]
+    '.zip'
+)
 
+# Suffixes of archives which may contain further java files
+ARCHIVE_SUFFIXES = SUFFIXES[1:]
 
-def scan_file(f, rules, cfg, dev=None, ignore_nonexistent=True):
+DEFAULT_WORKERS = 16
+
+# Deep mode
+ZIP_MAGICS = (b'PK\x03\x04', b'PK\x05\x06', b'PK\x07\x08')
+CLASS_MAGIC = b'\xca\xfe\xba\xbe'
+SNIFF_SIZE = 8
+MAX_NESTING = 8
+IN_MEMORY_LIMIT = 16 * 1024 * 1024
+
+# Errors of corrupt or unsupported archives
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError,
+        RuntimeError, EOFError, ValueError, zlib.error, lzma.LZMAError)
+
+
+def sniff(head):
+    """
+    Determine the type of a file from its first SNIFF_SIZE bytes.
+
+    Returns 'zip', 'class' or None
+    """
+    if head[:4] in ZIP_MAGICS:
+        return 'zip'
+
+    # Mach-O universal binaries share the magic number; at this position they
+    # have the number of architectures, class files their major version (>= 45).
+    if head[:4] == CLASS_MAGIC and len(head) >= 8 and int.from_bytes(head[6:8], 'big') >= 45:
+        return 'class'
+
+    return None
+
+
+def _is_java_archive(zf):
+    for name in zf.namelist():
+        if name.endswith('.class') or name.endswith(ARCHIVE_SUFFIXES) or name == 'META-INF/MANIFEST.MF':
+            return True
+
+    return False
+
+
+def scan_archive(zf, path, depth=0):
+    """
+    List the java archives nested in an open zipfile.ZipFile. Only the
+    central directory of each archive is read; nested archives are opened in
+    memory if they are small and streamed from the outer archive otherwise.
+
+    Returns (paths of nested archives, messages); the paths have the form
+    outer!/inner!/...
+    """
+    matches = []
+    messages = []
+
+    for info in zf.infolist():
+        if info.is_dir() or info.filename.endswith('.class'):
+            continue
+
+        inner_path = path + '!/' + info.filename
+        named = info.filename.endswith(ARCHIVE_SUFFIXES)
+
+        try:
+            with zf.open(info) as f:
+                if not named and sniff(f.read(SNIFF_SIZE)) != 'zip':
+                    continue
+
+            if depth + 1 >= MAX_NESTING:
+                messages.append("  Not descending into deeply nested archive '%s'." % inner_path)
+                if named:
+                    matches.append(inner_path)
+                continue
+
+            with zf.open(info) as f:
+                if info.file_size <= IN_MEMORY_LIMIT:
+                    f = io.BytesIO(f.read())
+
+                with zipfile.ZipFile(f) as inner:
+                    if not named and not _is_java_archive(inner):
+                        continue
+
+                    matches.append(inner_path)
+                    m, msgs = scan_archive(inner, inner_path, depth + 1)
+                    matches += m
+                    messages += msgs
+
+        except ARCHIVE_ERRORS as e:
+            if named:
+                matches.append(inner_path)
+            messages.append("  Cannot read archive '%s': %s" % (inner_path, e))
+
+    return (matches, messages)
+
+
+def scan_file_deep(path, named):
+    """
+    Sniff a regular file and list the archives nested in it.
+
+    :param named: True if the file's name has one of SUFFIXES
+
+    Returns (matching paths, messages)
+    """
     try:
-        s = os.lstat(f)
+        with open(path, 'rb') as f:
+            kind = sniff(f.read(SNIFF_SIZE))
+            if kind != 'zip':
+                return ([path] if named or kind == 'class' else [], [])
+
+            f.seek(0)
+            with zipfile.ZipFile(f) as zf:
+                if not named and not _is_java_archive(zf):
+                    return ([], [])
+
+                matches, messages = scan_archive(zf, path)
+                return ([path] + matches, messages)
+
     except FileNotFoundError:
-        if ignore_nonexistent:
-            print("  File '%s' vanished." % f, file=sys.stderr)
-            return False
+        return ([], ["  File '%s' vanished." % path])
+
+    except OSError as e:
+        return ([path] if named else [], ["  Cannot read '%s': %s" % (path, e)])
+
+    except ARCHIVE_ERRORS as e:
+        return ([path] if named else [], ["  Cannot read archive '%s': %s" % (path, e)])
+
+
+class ScanIndex:
+    """
+    Results of the last scan for each directory, keyed by (st_dev, st_ino):
+    the directory's mtime and the names of matching entries and
+    subdirectories. A directory whose mtime did not change has the same
+    entries and need not be listed again. Moreover the set of all matches of
+    the last scan.
+
+    The index should always be used with the same directories to scan.
+    """
+    def __init__(self):
+        self.dirs = {}
+        self.matches = set()
+        self.new_dirs = {}
+
+    @staticmethod
+    def load(path):
+        if not os.path.isfile(path):
+            return ScanIndex()
+
+        index = ScanIndex()
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+
+        index.dirs = state['dirs']
+        index.matches = state['matches']
+        return index
+
+    def save(self, path, matches):
+        """
+        Save the directories seen in the current scan and its matches
+        """
+        self.dirs = self.new_dirs
+        self.matches = set(matches)
+        self.new_dirs = {}
 
-        raise
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'dirs': self.dirs, 'matches': self.matches}, f)
 
-    if cfg['same_fs']:
-        if dev is None:
-            dev = s.st_dev
+        os.replace(tmp, path)
 
-        elif dev != s.st_dev:
-            print("  Not descending into filesystem mounted on '%s'." % f, file=sys.stderr)
-            return False
 
-    if stat.S_ISDIR(s.st_mode):
-        found = False
-        for c in os.listdir(f):
-            if scan_file(os.path.join(f, c), rules, cfg, dev):
-                found = True
+# Number of directories which an indexed scan processes in one task
+INDEX_BATCH = 64
 
-        return found
 
-    else:
-        for r in rules:
-            if r.fullmatch(os.path.basename(f)):
-                print(str(f))
-                return True
+def _scan_dir_indexed(d, cfg, dev):
+    """
+    scan_dir with an index. Unchanged directories only cost a stat, hence up
+    to INDEX_BATCH directories of a subtree are processed in one task.
+    Subdirectories are checked for --same-fs when they are processed
+    themselves since cached entries are not stat'ed by their parent.
+    """
+    index = cfg['index']
+    matches = []
+    messages = []
+    stack = [d]
+    processed = 0
 
-        return False
+    while stack and processed < INDEX_BATCH:
+        d = stack.pop()
+        processed += 1
 
-    raise RuntimeError("Saved your life.")
+        try:
+            s = os.lstat(d)
+        except FileNotFoundError:
+            messages.append("  File '%s' vanished." % d)
+            continue
+
+        if not stat.S_ISDIR(s.st_mode):
+            messages.append("  File '%s' vanished." % d)
+            continue
+
+        if cfg['same_fs'] and s.st_dev != dev:
+            messages.append("  Not descending into filesystem mounted on '%s'." % d)
+            continue
+
+        key = (s.st_dev, s.st_ino)
+        e = index.dirs.get(key)
+
+        if e is None or e['mtime_ns'] != s.st_mtime_ns:
+            try:
+                with os.scandir(d) as it:
+                    entries = list(it)
+
+            except (FileNotFoundError, NotADirectoryError):
+                messages.append("  File '%s' vanished." % d)
+                continue
+
+            e = {'mtime_ns': s.st_mtime_ns, 'matches': [], 'subdirs': []}
+            for c in entries:
+                try:
+                    if c.is_dir(follow_symlinks=False):
+                        e['subdirs'].append(c.name)
+                    elif c.name.endswith(SUFFIXES):
+                        e['matches'].append(c.name)
+
+                except FileNotFoundError:
+                    messages.append("  File '%s' vanished." % c.path)
+
+        # Keys are distinct per task; assigning to a dict is atomic
+        index.new_dirs[key] = e
+
+        matches += [os.path.join(d, n) for n in e['matches']]
+        stack += [os.path.join(d, n) for n in e['subdirs']]
+
+    return (matches, [(_scan_dir_indexed, (c, cfg, dev)) for c in stack], messages)
+
+
+def scan_dir(d, cfg, dev):
+    """
+    Scan a single directory. The file type of entries is taken from the
+    directory itself where possible, hence only subdirectories are stat'ed
+    and only if --same-fs is given.
+
+    Returns (matching paths, further tasks as (function, args), messages)
+    """
+    if cfg.get('index') is not None:
+        return _scan_dir_indexed(d, cfg, dev)
+
+    matches = []
+    tasks = []
+    messages = []
+
+    try:
+        with os.scandir(d) as it:
+            entries = list(it)
+
+    except (FileNotFoundError, NotADirectoryError):
+        return ([], [], ["  File '%s' vanished." % d])
+
+    for e in entries:
+        try:
+            is_dir = e.is_dir(follow_symlinks=False)
+
+            if is_dir and cfg['same_fs'] and e.stat(follow_symlinks=False).st_dev != dev:
+                messages.append("  Not descending into filesystem mounted on '%s'." % e.path)
+                continue
+
+            is_file = not is_dir and cfg['deep'] and e.is_file(follow_symlinks=False)
+
+        except FileNotFoundError:
+            messages.append("  File '%s' vanished." % e.path)
+            continue
+
+        named = e.name.endswith(SUFFIXES)
+
+        if is_dir:
+            tasks.append((scan_dir, (e.path, cfg, dev)))
+        elif is_file:
+            tasks.append((_scan_file_deep, (e.path, named)))
+        elif named:
+            matches.append(e.path)
+
+    return (matches, tasks, messages)
+
+
+def _scan_file_deep(path, named):
+    matches, messages = scan_file_deep(path, named)
+    return (matches, [], messages)
+
+
+def iter_java_files(roots, cfg, workers=DEFAULT_WORKERS):
+    """
+    Find java files below the given roots. Directories (and in deep mode
+    files) are scanned on a thread pool; matches are yielded as soon as they
+    are found.
+    """
+    todo = collections.deque()
+
+    for f in roots:
+        s = os.lstat(f)
+        named = os.path.basename(f).endswith(SUFFIXES)
+
+        if stat.S_ISDIR(s.st_mode):
+            todo.append((scan_dir, (f, cfg, s.st_dev)))
+        elif cfg['deep'] and stat.S_ISREG(s.st_mode):
+            todo.append((_scan_file_deep, (f, named)))
+        elif named:
+            yield f
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for matches, tasks, messages in pool_utils.bounded_map(executor, todo, 4 * workers):
+            for m in messages:
+                print(m, file=sys.stderr)
+
+            todo.extend(tasks)
+            yield from matches
 
 
 def main():
@@ -65,18 +350,49 @@ def main():
         type=str, nargs="+", help="directories to examine")
 
     parser.add_argument("--same-fs", action="store_true", help="Do not descend into mountpoints")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_WORKERS,
+        help="Number of threads which scan directories (default: %d)" % DEFAULT_WORKERS)
+    parser.add_argument("--deep", action="store_true",
+        help="Identify java files by their content as well, and list java archives nested "
+            "in archives as outer!/inner. Class files inside archives are not listed.")
+    parser.add_argument("--index", metavar="<file>",
+        help="Keep the results per directory in this file and only list directories "
+            "whose mtime changed since the last run")
+    parser.add_argument("--changes", action="store_true",
+        help="With --index, print only matches which were added (+) or removed (-) "
+            "since the last run")
 
     args = parser.parse_args()
-    rules = [re.compile(r) for r in RULES]
+
+    if args.index and args.deep:
+        parser.error("--index cannot be combined with --deep since changes to file "
+            "contents do not change the mtime of directories")
+
+    if args.changes and not args.index:
+        parser.error("--changes requires --index")
 
     cfg = {
-        'same_fs': args.same_fs
+        'same_fs': args.same_fs,
+        'deep': args.deep,
+        'index': ScanIndex.load(args.index) if args.index else None
     }
 
-    found = False
-    for d in args.directories:
-        if scan_file(d, rules, cfg, ignore_nonexistent=False):
-            found = True
+    found = []
+    for f in iter_java_files(args.directories, cfg, args.jobs):
+        if not args.changes:
+            print(f, flush=True)
+
+        found.append(f)
+
+    if args.index:
+        index = cfg['index']
+        if args.changes:
+            for f in sorted(set(found) - index.matches):
+                print("+ %s" % f)
+            for f in sorted(index.matches - set(found)):
+                print("- %s" % f)
+
+        index.save(args.index, found)
 
     sys.exit(0 if found else 1)
 
@@ -1,37 +1,598 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
 import os
+import platform
+import sqlite3
 import stat
+import sys
+import time
+import pool_utils
 
-def main():
-    root_device = None
 
-    def _work(f):
-        nonlocal root_device
+STRATEGIES = ['buffered', 'direct', 'fadvise', 'mmap']
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 4
+SLOW_READ_MS = 100
+MAX_SLOW_READS = 1000
+
+# Scrub mode
+CHECKPOINT_INTERVAL = 1000
+DIGEST_SIZE = 16
+
+
+def _walk_key(root, path):
+    """
+    Path components relative to root; walk yields files in ascending order of
+    this key
+    """
+    rel = os.path.relpath(path, root)
+    return () if rel == '.' else tuple(rel.split(os.sep))
+
+
+def walk(root, start_after=None, on_error=None):
+    """
+    Yield the regular files below root in sorted depth-first order without
+    crossing filesystem borders
+
+    :param start_after: Skip all files up to and including this one, e.g. to
+        resume an interrupted run; directories which lie entirely before it
+        are not entered.
+    :param on_error: Callable on_error(path, OSError) for entries which cannot
+        be examined or directories which cannot be listed; these are skipped.
+    """
+    root_device = os.lstat(root).st_dev
+    stack = [root]
+    start_key = _walk_key(root, start_after) if start_after else None
 
-        st_buf = os.lstat(f)
-        if root_device is None:
-            root_device = st_buf.st_dev
+    while stack:
+        f = stack.pop()
+
+        if start_key is not None:
+            k = _walk_key(root, f)
+            if k <= start_key and k != start_key[:len(k)]:
+                continue
+
+            if k == start_key:
+                continue
+
+            # Everything after the first file or directory beyond start_after
+            # comes after it, too
+            if k > start_key:
+                start_key = None
+
+        try:
+            st_buf = os.lstat(f)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            if on_error is not None:
+                on_error(f, e)
+            continue
 
         # Don't cross filesystem borders
         if st_buf.st_dev != root_device:
-            return
+            continue
 
-        print(f)
-
-        # Read regular files
         if stat.S_ISREG(st_buf.st_mode):
-            with open(f, 'rb') as fhandle:
-                while True:
-                    buf = fhandle.read(1024 * 1024)
-                    if len(buf) == 0:
-                        break
+            yield f
 
-        # Recurse on directories
         elif stat.S_ISDIR(st_buf.st_mode):
-            for c in list(sorted(os.listdir(f))):
-                _work(os.path.join(f, c))
+            try:
+                children = os.listdir(f)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                if on_error is not None:
+                    on_error(f, e)
+                continue
+
+            stack += [os.path.join(f, c) for c in sorted(children, reverse=True)]
+
+
+class LatencyHistogram:
+    """
+    Counts of read latencies in buckets of powers of two microseconds
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.max_ns = 0
+
+    def add(self, ns):
+        self.counts[(ns // 1000).bit_length()] += 1
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+    def to_dict(self):
+        return {
+            'buckets': [{'lt_us': 1 << b, 'count': self.counts[b]} for b in sorted(self.counts)],
+            'max_us': self.max_ns / 1000
+        }
+
+
+class FileResult:
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.seconds = 0.0
+        self.error = None
+        self.histogram = LatencyHistogram()
+
+        # Scrub mode: content hash and stat result from before reading, None
+        # if the file changed while it was read
+        self.digest = None
+        self.stat = None
+
+        # [(offset, milliseconds)]
+        self.slow_reads = []
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'bytes': self.size,
+            'seconds': self.seconds,
+            'mb_per_s': self.size / self.seconds / 1e6 if self.seconds else None,
+            'error': self.error
+        }
+
+
+def _timed_reads(read, result, block_size, slow_ns, consume):
+    """
+    Call read(offset) -> buffer until it returns an empty buffer
+    """
+    offset = 0
+    while True:
+        t = time.perf_counter_ns()
+        chunk = read(offset)
+        d = time.perf_counter_ns() - t
+
+        result.histogram.add(d)
+        if d >= slow_ns:
+            result.slow_reads.append((offset, d / 1e6))
+
+        if not chunk:
+            return offset
+
+        if consume is not None:
+            consume(chunk)
+
+        offset += len(chunk)
+
+
+def read_file(path, strategy='buffered', block_size=BLOCK_SIZE, slow_ms=SLOW_READ_MS,
+        consume=None):
+    """
+    Read a file with the given strategy, timing each read:
+
+      buffered: read() through the page cache
+      direct: O_DIRECT into a page-aligned buffer, bypassing the page cache;
+              block_size must be a multiple of the logical block size
+      fadvise: like buffered, with POSIX_FADV_SEQUENTIAL and NOREUSE; pages
+               are dropped from the cache with DONTNEED after being read
+      mmap: map the file and copy it block by block
+
+    :param consume: Callable which receives each block as bytes-like object,
+        e.g. to hash the file
+
+    Returns a FileResult
+    """
+    result = FileResult(path)
+    slow_ns = slow_ms * 1000000
+    start = time.perf_counter()
+
+    try:
+        if strategy == 'direct':
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+
+        try:
+            if strategy == 'mmap':
+                size = os.fstat(fd).st_size
+                if size == 0:
+                    result.size = 0
+                else:
+                    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+                        if hasattr(m, 'madvise'):
+                            m.madvise(mmap.MADV_SEQUENTIAL)
+
+                        result.size = _timed_reads(lambda o: m[o:o + block_size],
+                                result, block_size, slow_ns, consume)
+
+            else:
+                # An anonymous mapping is page-aligned as required by O_DIRECT
+                buf = mmap.mmap(-1, block_size)
+                view = memoryview(buf)
+
+                if strategy == 'fadvise':
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+
+                def _read(offset):
+                    n = os.preadv(fd, [buf], offset)
+                    if strategy == 'fadvise' and n:
+                        os.posix_fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+
+                    return view[:n]
+
+                try:
+                    result.size = _timed_reads(_read, result, block_size, slow_ns, consume)
+                finally:
+                    view.release()
+                    buf.close()
+
+        finally:
+            os.close(fd)
+
+    except OSError as e:
+        result.error = str(e)
+
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def scrub_file(path, strategy='buffered', block_size=BLOCK_SIZE, slow_ms=SLOW_READ_MS):
+    """
+    read_file which also hashes the file. If the file's metadata changed
+    while it was read, the result has no stat.
+    """
+    try:
+        before = os.lstat(path)
+    except OSError as e:
+        result = FileResult(path)
+        result.error = str(e)
+        return result
+
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    result = read_file(path, strategy, block_size, slow_ms, h.update)
+    result.digest = h.digest()
+
+    try:
+        after = os.lstat(path)
+    except OSError:
+        after = None
+
+    if after is not None and (before.st_ino, before.st_size, before.st_mtime_ns) == \
+            (after.st_ino, after.st_size, after.st_mtime_ns):
+        result.stat = before
+
+    return result
+
+
+class ScrubDB:
+    """
+    Baseline of file contents for bit rot detection: for each path the inode,
+    size, mtime_ns and content hash when it was last read, together with the
+    number of the run which last saw it. Moreover the progress of the current
+    run, which is committed together with the baseline so that an interrupted
+    run can be resumed.
+
+    Paths are stored as bytes (os.fsencode) since file names need not be
+    valid UTF-8.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                'path BLOB PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+                'hash BLOB, run INTEGER)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+
+        # Databases of version 0 stored paths as text
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+            self._conn.execute("UPDATE files SET path = CAST(path AS BLOB) WHERE typeof(path) = 'text'")
+            self._conn.execute("UPDATE state SET value = CAST(value AS BLOB) "
+                    "WHERE key IN ('root', 'checkpoint') AND typeof(value) = 'text'")
+            self._conn.execute('PRAGMA user_version = 1')
+
+        self._conn.commit()
+
+    def _get(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def start(self, root, restart=False):
+        """
+        Start a run or resume the interrupted run of the same root.
+
+        Returns the path after which to resume or None
+        """
+        checkpoint = self._get('checkpoint')
+        if checkpoint is not None and self._get('root') == os.fsencode(root) and not restart:
+            return os.fsdecode(checkpoint)
+
+        self._set('run', self._get('run', 0) + 1)
+        self._set('root', os.fsencode(root))
+        self._set('checkpoint', None)
+        self._conn.commit()
+        return None
+
+    def check(self, r):
+        """
+        Compare a scrub_file result to the baseline and update the baseline.
+
+        Returns 'new', 'ok', 'changed' (metadata changed, too), 'corrupt'
+        (content changed although the metadata did not) or, if the file could
+        not be read or changed while it was read, 'error' or 'busy'; the
+        baseline of such files is kept.
+        """
+        if r.error or r.stat is None:
+            self.keep(r.path)
+            return 'error' if r.error else 'busy'
+
+        s = r.stat
+        path = os.fsencode(r.path)
+        row = self._conn.execute('SELECT inode, size, mtime_ns, hash FROM files WHERE path = ?',
+                (path,)).fetchone()
+
+        if row is None:
+            status = 'new'
+        elif tuple(row[:3]) != (s.st_ino, s.st_size, s.st_mtime_ns):
+            status = 'changed'
+        elif row[3] != r.digest:
+            status = 'corrupt'
+        else:
+            status = 'ok'
+
+        # Keep the baseline of corrupt files to report them again until they
+        # are restored or rewritten
+        if status == 'corrupt':
+            self._conn.execute('UPDATE files SET run = ? WHERE path = ?', (self._get('run'), path))
+        else:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    (path, s.st_ino, s.st_size, s.st_mtime_ns, r.digest, self._get('run')))
+
+        return status
+
+    def keep(self, path, below=False):
+        """
+        Keep the baseline of a file which was not checked in this run, or of
+        all files below a directory if below is True, so that finish does not
+        forget about them
+        """
+        path = os.fsencode(path)
+        if below:
+            prefix = os.path.join(path, b'')
+            self._conn.execute('UPDATE files SET run = ? WHERE substr(path, 1, ?) = ?',
+                    (self._get('run'), len(prefix), prefix))
+        else:
+            self._conn.execute('UPDATE files SET run = ? WHERE path = ?', (self._get('run'), path))
+
+    def checkpoint(self, path):
+        """
+        Record that all files up to and including path were processed
+        """
+        self._set('checkpoint', os.fsencode(path))
+        self._conn.commit()
+
+    def finish(self, root):
+        """
+        Complete the run: forget about files below root which were not seen.
+
+        Returns the number of removed files
+        """
+        prefix = os.path.join(os.fsencode(root), b'')
+        cur = self._conn.execute('DELETE FROM files WHERE run < ? AND substr(path, 1, ?) = ?',
+                (self._get('run'), len(prefix), prefix))
+
+        self._set('checkpoint', None)
+        self._conn.commit()
+        return cur.rowcount
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def run(files, strategy='buffered', block_size=BLOCK_SIZE, workers=DEFAULT_WORKERS,
+        slow_ms=SLOW_READ_MS, on_result=None, reader=read_file):
+    """
+    Read files on a thread pool.
+
+    :param on_result: Callable on_result(FileResult), called in the calling
+        thread for each file
+    :param reader: read_file or scrub_file
+
+    Returns the aggregate report as dict
+    """
+    histogram = LatencyHistogram()
+    slow_reads = []
+    errors = []
+    total_bytes = 0
+    nfiles = 0
+
+    def _collect(r):
+        nonlocal total_bytes, nfiles
+        nfiles += 1
+        total_bytes += r.size
+        histogram.merge(r.histogram)
+
+        if r.error:
+            errors.append({'path': r.path, 'error': r.error})
+
+        for offset, ms in r.slow_reads:
+            if len(slow_reads) < MAX_SLOW_READS:
+                slow_reads.append({'path': r.path, 'offset': offset, 'ms': ms})
+
+        if on_result is not None:
+            on_result(r)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for r in pool_utils.bounded_map(executor,
+                ((reader, (f, strategy, block_size, slow_ms)) for f in files), 4 * workers):
+            _collect(r)
+
+    seconds = time.perf_counter() - start
+
+    return {
+        'strategy': strategy,
+        'block_size': block_size,
+        'workers': workers,
+        'files': nfiles,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'mb_per_s': total_bytes / seconds / 1e6 if seconds else None,
+        'latency': histogram.to_dict(),
+        'slow_read_ms': slow_ms,
+        'slow_reads': slow_reads,
+        'errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read all regular files of a filesystem "
+            "and measure the read throughput and latency")
+    parser.add_argument('root', nargs='?', default='/',
+            help="Directory to start at; other filesystems are not entered (default: /)")
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+            help="Number of files which are read in parallel (default: %d)" % DEFAULT_WORKERS)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+            help="Size of each read in bytes (default: %d)" % BLOCK_SIZE)
+    parser.add_argument('--strategy', choices=STRATEGIES, default='buffered',
+            help="How files are read (default: buffered)")
+    parser.add_argument('--slow-ms', type=float, default=SLOW_READ_MS,
+            help="Reads taking at least this long are listed in the report (default: %d)" %
+                SLOW_READ_MS)
+    parser.add_argument('--per-file', action='store_true',
+            help="Include a result for each file in the report")
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help="Print each file with its throughput to stderr")
+    parser.add_argument('--scrub', metavar='<database>',
+            help="Hash each file and compare it to the baseline in this database; report "
+                "files whose content changed although their inode, size and mtime did "
+                "not. Progress is saved, an interrupted run of the same root is resumed.")
+    parser.add_argument('--restart', action='store_true',
+            help="With --scrub, start a new run instead of resuming an interrupted one")
+    parser.add_argument('-o', '--output', help="Write the JSON report to this file instead of stdout")
+
+    args = parser.parse_args()
+
+    if args.strategy == 'direct' and args.block_size % mmap.PAGESIZE:
+        parser.error("--block-size must be a multiple of %d with O_DIRECT" % mmap.PAGESIZE)
+
+    per_file = []
+    db = None
+    start_after = None
+    root = args.root
+
+    if args.scrub:
+        root = os.path.abspath(args.root)
+        db = ScrubDB(args.scrub)
+        start_after = db.start(root, args.restart)
+
+    scrub = collections.Counter()
+    corrupt = []
+    extra_errors = []
+
+    # Files in the order of the walk which are not known to be processed,
+    # for checkpoints
+    order = collections.deque()
+    done = set()
+    watermark = None
+    since_checkpoint = 0
+    last_checkpoint = time.monotonic()
+
+    def _walk_error(path, e):
+        print("Cannot examine '%s': %s" % (path, e), file=sys.stderr)
+        extra_errors.append({'path': path, 'error': str(e)})
+
+        # Files below a directory which cannot be listed are not seen; keep
+        # their baseline
+        if db is not None:
+            db.keep(path, below=True)
+            db.keep(path)
+
+    def _files():
+        for f in walk(root, start_after, _walk_error):
+            order.append(f)
+            yield f
+
+    def _scrub(r):
+        nonlocal watermark, since_checkpoint, last_checkpoint
+
+        status = db.check(r)
+        scrub[status] += 1
+
+        if status == 'corrupt':
+            corrupt.append(r.path)
+            print("Content of '%s' changed without a change of its metadata." % r.path,
+                    file=sys.stderr)
+        elif status == 'error':
+            print("Cannot scrub '%s': %s" % (r.path, r.error), file=sys.stderr)
+        elif status == 'busy':
+            print("Cannot scrub '%s': changed while it was read" % r.path, file=sys.stderr)
+            extra_errors.append({'path': r.path, 'error': "changed while it was read"})
+
+        done.add(r.path)
+        while order and order[0] in done:
+            watermark = order.popleft()
+            done.discard(watermark)
+
+        since_checkpoint += 1
+        if watermark is not None and (since_checkpoint >= CHECKPOINT_INTERVAL or
+                time.monotonic() - last_checkpoint > 60):
+            db.checkpoint(watermark)
+            since_checkpoint = 0
+            last_checkpoint = time.monotonic()
+
+    def _on_result(r):
+        if db is not None:
+            _scrub(r)
+
+        if args.per_file:
+            per_file.append(r.to_dict())
+
+        if args.verbose:
+            d = r.to_dict()
+            print("%s: %s" % (r.path, r.error if r.error else
+                '%d bytes, %.1f MB/s' % (r.size, d['mb_per_s'] or 0)), file=sys.stderr)
+
+    try:
+        report = run(_files(), args.strategy, args.block_size, args.workers,
+                args.slow_ms, _on_result, scrub_file if db else read_file)
+        report['errors'] += extra_errors
+
+        if db is not None:
+            scrub['removed'] = db.finish(root)
+            report['scrub'] = dict(scrub, resumed_after=start_after, corrupt_files=corrupt)
+
+    except BaseException:
+        if db is not None and watermark is not None:
+            db.checkpoint(watermark)
+        raise
+
+    finally:
+        if db is not None:
+            db.close()
+
+    report['root'] = root
+    report['python'] = platform.python_version()
+    report['platform'] = platform.platform()
+    report['time'] = time.time()
+    if args.per_file:
+        report['per_file'] = per_file
 
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
 
-    _work('/')
+    if corrupt:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
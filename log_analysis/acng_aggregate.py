@@ -0,0 +1,245 @@
+"""
+Mergeable accumulators for single-pass analyses of log records
+"""
+import collections
+import hashlib
+import math
+
+
+class Accumulator:
+    """
+    Accumulates values in constant memory. Accumulators of the same type can
+    be merged, e.g. to combine the results of several log files.
+    """
+    def add(self, value):
+        raise NotImplementedError
+
+    def add_all(self, values):
+        """
+        Add a sequence of values
+        """
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class Min(Accumulator):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def add_all(self, values):
+        if len(values):
+            self.add(min(values))
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Max(Accumulator):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def add_all(self, values):
+        if len(values):
+            self.add(max(values))
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Count(Accumulator):
+    def __init__(self):
+        self.value = 0
+
+    def add(self, value):
+        self.value += 1
+
+    def add_all(self, values):
+        self.value += len(values)
+
+    def merge(self, other):
+        self.value += other.value
+
+    def result(self):
+        return self.value
+
+
+class Sum(Accumulator):
+    def __init__(self):
+        self.value = 0
+
+    def add(self, value):
+        self.value += value
+
+    def add_all(self, values):
+        self.value += sum(values)
+
+    def merge(self, other):
+        self.value += other.value
+
+    def result(self):
+        return self.value
+
+
+class HyperLogLog(Accumulator):
+    """
+    Approximate number of distinct values. The standard error is about
+    1.04 / sqrt(2^p), i.e. 3.3% for p = 10 with 1 KiB of registers.
+    """
+    def __init__(self, p=10):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        elif not isinstance(value, bytes):
+            value = str(value).encode('utf8')
+
+        # A hash which is stable across processes, unlike hash()
+        h = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+        idx = h & ((1 << self.p) - 1)
+        w = h >> self.p
+        rank = 64 - self.p - w.bit_length() + 1
+
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def result(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        # Small range correction
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+
+class Aggregation:
+    """
+    A set of named accumulators which are fed from fields of record tuples,
+    optionally grouped by another field.
+
+    :param specs: dict name -> (accumulator class, field index); the field
+        index is ignored by Count.
+    :param key: Field index to group by or None
+    """
+    def __init__(self, specs, key=None):
+        self.specs = specs
+        self.key = key
+        self.groups = {}
+
+    def _new_group(self):
+        return {name: cls() for name, (cls, _) in self.specs.items()}
+
+    def add(self, record):
+        k = None if self.key is None else record[self.key]
+        group = self.groups.get(k)
+        if group is None:
+            group = self.groups[k] = self._new_group()
+
+        for name, (_, field) in self.specs.items():
+            group[name].add(record[field] if field is not None else None)
+
+    def add_columns(self, columns):
+        """
+        Add records given column by column, i.e. columns[field] is the
+        sequence of the values of field. The values of each group are passed
+        to the accumulators at once.
+        """
+        n = len(columns[0])
+        if not n:
+            return
+
+        fields = {field for _, field in self.specs.values() if field is not None}
+
+        if self.key is None:
+            counts = {None: n}
+            values = {None: {field: columns[field] for field in fields}}
+        else:
+            keys = columns[self.key]
+            counts = collections.Counter(keys)
+            values = {k: {field: [] for field in fields} for k in counts}
+
+            for field in fields:
+                appends = {k: v[field].append for k, v in values.items()}
+                for k, value in zip(keys, columns[field]):
+                    appends[k](value)
+
+        for k, count in counts.items():
+            group = self.groups.get(k)
+            if group is None:
+                group = self.groups[k] = self._new_group()
+
+            for name, (_, field) in self.specs.items():
+                group[name].add_all(values[k][field] if field is not None else [None] * count)
+
+    def merge(self, other):
+        for k, other_group in other.groups.items():
+            group = self.groups.get(k)
+            if group is None:
+                group = self.groups[k] = self._new_group()
+
+            for name, acc in group.items():
+                acc.merge(other_group[name])
+
+    def result(self):
+        """
+        dict name -> result or, if grouped, dict key -> dict name -> result
+        """
+        results = {k: {name: acc.result() for name, acc in group.items()}
+                for k, group in self.groups.items()}
+
+        if self.key is None:
+            return results.get(None, {name: cls().result() for name, (cls, _) in self.specs.items()})
+
+        return results
+
+
+def run(records, aggregations):
+    """
+    Feed all records to all aggregations in a single pass
+    """
+    aggregations = list(aggregations)
+    for r in records:
+        for a in aggregations:
+            a.add(r)
+
+
+def run_columns(columns, aggregations):
+    """
+    Feed records given column by column (see Aggregation.add_columns) to all
+    aggregations
+    """
+    for a in aggregations:
+        a.add_columns(columns)
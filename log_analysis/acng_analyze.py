@@ -1,34 +1,46 @@
 #!/usr/bin/python3
+import argparse
+import array
+import bz2
+import concurrent.futures
 import datetime
 import glob
+import gzip
+import itertools
+import lzma
+import operator
 import os
+import pickle
 import re
-import socket
 import sys
+import time
+import acng_aggregate
+import acng_resolve
+import acng_store
+import acng_traffic
 
 
 LOG_FILE_PATH = '/var/log/apt-cacher-ng'
 VERBOSE = True
 RESOLVE = True
+FOLLOW_INTERVAL = 10
 
 
-class Timerange:
-    def __init__(self):
-        self._tss = set()
-
-    def add(self, t):
-        if not isinstance(t, datetime.datetime):
-            raise ValueError("Can only add datetime.datetime objects")
-        self._tss.add(t)
-
-    def begin(self):
-        return min(self._tss)
-
-    def end(self):
-        return max(self._tss)
-
-    def __len__(self):
-        return len(self._tss)
+def make_analyses():
+    """
+    Aggregations which main computes in a single pass over the records
+    """
+    return {
+        'timeframe': acng_aggregate.Aggregation({
+            'begin': (acng_aggregate.Min, acng_store.TIMESTAMP),
+            'end': (acng_aggregate.Max, acng_store.TIMESTAMP)
+        }),
+        'clients': acng_aggregate.Aggregation({
+            'begin': (acng_aggregate.Min, acng_store.TIMESTAMP),
+            'end': (acng_aggregate.Max, acng_store.TIMESTAMP),
+            'requests': (acng_aggregate.Count, None)
+        }, key=acng_store.IP)
+    }
 
 
 def ip_sort_key(ip):
@@ -49,106 +61,605 @@ def ip_sort_key(ip):
     return k + ip
 
 
-def read_acng_log(filename, log_output=sys.stdout):
+def parse_line(line):
+    """
+    Parse a log line.
+
+    Returns (timestamp in seconds since the epoch, direction code, size, client
+    ip, requested filename); see acng_store.DIR_CODES for direction codes.
+    """
+    t = line.rstrip('\n').split('|')
+    if len(t) != 5:
+        raise ParseError
+
+    ts, inout, size, ip, fn = t
+    try:
+        r = (int(ts), acng_store.DIR_CODES[inout], int(size), ip, fn)
+
+    except (ValueError, KeyError) as e:
+        raise ParseError from e
+
+    # The record store keeps timestamps and sizes in 64 bit integers
+    if not (-1 << 63) <= r[0] < (1 << 63) or not (-1 << 63) <= r[2] < (1 << 63):
+        raise ParseError
+
+    return r
+
+
+COMPRESSED_SUFFIXES = (('.gz', gzip.open), ('.xz', lzma.open), ('.bz2', bz2.open))
+
+
+def open_log(filename, binary=False):
+    """
+    Open a log file for reading, decompressing it on the fly if needed
+    """
+    for suffix, opener in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            return opener(filename, 'rb') if binary else opener(filename, 'rt', encoding='utf8')
+
+    return open(filename, 'rb') if binary else open(filename, 'r', encoding='utf8')
+
+
+def _rotation_number(filename):
+    """
+    Rotation number of a log file, e.g. 2 for apt-cacher.log.2.gz and -1 for
+    the current log file
+    """
+    m = re.search(r'apt-cacher\.log\.(\d+)', os.path.basename(filename))
+    return int(m[1]) if m else -1
+
+
+def log_filenames(path):
+    """
+    Log files in chronological order, i.e. the oldest rotated log first and
+    the current log last
+    """
+    return [os.path.abspath(f) for f in
+            sorted(glob.glob(os.path.join(path, 'apt-cacher.log*')),
+                key=lambda f: (-_rotation_number(f), f))]
+
+
+CHUNK_SIZE = 1 << 20
+INVALID_SAMPLES = 5
+
+
+class InvalidLines:
+    """
+    Number of invalid lines in a log file and the first few of them as
+    (line number, line) for diagnostics
+    """
+    def __init__(self, max_samples=INVALID_SAMPLES):
+        self.count = 0
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, lineno, line):
+        self.count += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append((lineno, line))
+
+
+def _parse_text_fast(text, store):
+    """
+    Parse newline separated lines column-wise and append them to store, see
+    read_log_chunks.
+
+    The text is split at '|' only, so that the last field of each line and
+    the first field of the next one end up in one element, e.g. 'fn\nts'.
+    Every line has exactly five fields if and only if these are exactly the
+    elements 4, 8, ... and each of them contains exactly one newline.
+
+    Returns False without modifying store if any line is invalid.
+    """
+    fields = text.split('|')
+    n = text.count('\n') + 1
+    if len(fields) != 4 * n + 1:
+        return False
+
+    boundaries = fields[4:-1:4]
+    if not all(map(operator.contains, boundaries, itertools.repeat('\n'))):
+        return False
+
+    # Each boundary contains at least one newline and there are only n - 1
+    parts = '\n'.join(boundaries).split('\n') if boundaries else []
+
+    try:
+        ts = array.array('q', map(int, [fields[0]] + parts[1::2]))
+        dirs = array.array('B', map(acng_store.DIR_CODES.__getitem__, fields[1::4]))
+        sizes = array.array('q', map(int, fields[2::4]))
+
+    except (ValueError, KeyError, OverflowError):
+        return False
+
+    store.extend_columns(ts, dirs, sizes, fields[3::4], parts[0::2] + [fields[-1]])
+    return True
+
+
+def _parse_lines(lines, lineno, store, invalid, fast=True):
+    """
+    Parse lines whose first one has number lineno + 1. If the fast path fails,
+    the lines are split in halves so that only the neighbourhood of invalid
+    lines is parsed line by line.
+
+    :param fast: False if the fast path already failed on these lines
+    """
+    if len(lines) > 16:
+        if fast and _parse_text_fast('\n'.join(lines), store):
+            return
+
+        half = len(lines) // 2
+        _parse_lines(lines[:half], lineno, store, invalid)
+        _parse_lines(lines[half:], lineno + half, store, invalid)
+        return
+
+    for line in lines:
+        lineno += 1
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf8')
+
+            store.append(*parse_line(line))
+
+        except (ParseError, UnicodeDecodeError):
+            invalid.add(lineno, line)
+
+
+def _parse_chunk(chunk, lineno, store, invalid):
     """
-    Returns:
-    [{
-        'timestamp': :datetime,
-        'dir': in|out|error,
-        'size: transferred size / bytes,
-        'ip': client ip,
-        'filename': requested filename
-    }}
+    Parse a chunk of complete lines (without the final newline) whose first
+    line has number lineno + 1.
+
+    Returns the number of lines in the chunk
     """
-    records = []
+    try:
+        text = chunk.decode('utf8')
 
-    with open(filename, 'r', encoding='utf8') as f:
-        lineno = 0
-        for line in f:
-            lineno += 1
+    except UnicodeDecodeError:
+        lines = chunk.split(b'\n')
+        for i, line in enumerate(lines):
+            _parse_lines([line], lineno + i, store, invalid)
 
-            try:
-                t = line.split('|')
-                if len(t) != 5:
-                    raise ParseError
+        return len(lines)
 
-                ts, inout, size, ip, fn = t
-                try:
-                    records.append({
-                        'timestamp': datetime.datetime.fromtimestamp(int(ts)),
-                        'dir': {'O': 'out', 'I': 'in', 'E': 'error'}[inout],
-                        'size': size,
-                        'ip': ip,
-                        'filename': fn
-                    })
+    if _parse_text_fast(text, store):
+        return text.count('\n') + 1
+
+    lines = text.split('\n')
+    _parse_lines(lines, lineno, store, invalid, fast=False)
+    return len(lines)
+
+
+def read_log_chunks(f, store, invalid, chunk_size=CHUNK_SIZE, lineno=0, complete=True):
+    """
+    Parse a binary log stream in large chunks into a columnar record store.
+    Fields are split and converted a whole chunk at a time instead of line by
+    line.
+
+    :param store: acng_store.RecordStore or another object with its
+        extend_columns and append methods, e.g. acng_traffic.TrafficStats
+    :param invalid: InvalidLines which records lines that cannot be parsed
+    :param lineno: Number of lines before the current position of f
+    :param complete: False if the stream may end with an incomplete line which
+        is still being written; such a line is not parsed then.
+
+    Returns (number of bytes, number of lines) which were parsed
+    """
+    consumed = 0
+    lines = 0
+    rest = b''
 
-                except (ValueError, OverflowError, KeyError) as e:
-                    raise ParseError from e
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
 
-            except ParseError:
-                print('Invalid line %d in log file "%s" - ignoring.' % (lineno, filename),
-                        file=log_output)
+        data = rest + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            rest = data
+            continue
+
+        lines += _parse_chunk(data[:end], lineno + lines, store, invalid)
+        consumed += end + 1
+        rest = data[end + 1:]
+
+    if rest and complete:
+        lines += _parse_chunk(rest, lineno + lines, store, invalid)
+        consumed += len(rest)
+
+    return (consumed, lines)
+
+
+def _print_invalid(filename, invalid, log_output):
+    if invalid.count:
+        print('%d invalid lines in log file "%s" - ignoring, e.g.:' % (invalid.count, filename),
+                file=log_output)
+        for lineno, line in invalid.samples:
+            print('    %d: %r' % (lineno, line), file=log_output)
+
+
+def read_acng_log(filename, log_output=sys.stdout, store=None):
+    """
+    Read a log file into a columnar record store. Invalid lines are counted
+    and a few of them are reported.
+
+    :param store: Append to this acng_store.RecordStore (or a store like
+        object, see read_log_chunks) instead of a new one
+    """
+    if store is None:
+        store = acng_store.RecordStore()
+
+    cnt = len(store)
+    invalid = InvalidLines()
+
+    with open_log(filename, binary=True) as f:
+        read_log_chunks(f, store, invalid)
+
+    _print_invalid(filename, invalid, log_output)
 
     if VERBOSE:
-        print('Read %d records from "%s".' % (len(records), filename))
+        print('Read %d records from "%s".' % (len(store) - cnt, filename))
 
-    return records
+    return store
 
 
-def read_acng_logs(path, log_output=sys.stdout):
-    records = []
-    for filename in sorted(glob.glob(os.path.join(path, 'apt-cacher.log*')), reverse=True):
-        filename = os.path.abspath(filename)
-        records += read_acng_log(filename, log_output)
+def read_acng_logs(path, log_output=sys.stdout, jobs=1):
+    """
+    Read all log files into a columnar record store in chronological order.
 
-    return records
+    :param jobs: Number of worker processes which read the files; with more
+        than one, messages about invalid lines go to the workers' stdout.
+    """
+    store = acng_store.RecordStore()
 
+    if jobs == 1:
+        for filename in log_filenames(path):
+            read_acng_log(filename, log_output, store)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for partial in executor.map(read_acng_log, log_filenames(path)):
+                store.extend(partial)
+
+    return store
+
+
+def _read_traffic(filename, bucket):
+    return read_acng_log(filename, store=acng_traffic.TrafficStats(bucket))
 
-def analyze_find_log_timeframe(records):
-    a = None
-    b = None
 
-    for r in records:
-        t = r['timestamp']
-        if a is None or t < a:
-            a = t
+def read_acng_traffic(path, bucket='hour', log_output=sys.stdout, jobs=1):
+    """
+    Compute the traffic statistics of all log files while parsing them,
+    without keeping the records.
+
+    :param jobs: See read_acng_logs
+
+    Returns an acng_traffic.TrafficStats
+    """
+    stats = acng_traffic.TrafficStats(bucket)
+
+    if jobs == 1:
+        for filename in log_filenames(path):
+            read_acng_log(filename, log_output, stats)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for partial in executor.map(_read_traffic, log_filenames(path), itertools.repeat(bucket)):
+                stats.merge(partial)
+
+    return stats
+
+
+def timeframe_result(aggregation):
+    """
+    (begin, end) as datetimes from the 'timeframe' aggregation
+    """
+    res = aggregation.result()
+    if res['begin'] is None:
+        return (None, None)
+
+    return (datetime.datetime.fromtimestamp(res['begin']),
+            datetime.datetime.fromtimestamp(res['end']))
+
 
-        if b is None or t > b:
-            b = t
+def clients_result(aggregation):
+    """
+    Sorted list of (ip, dict) from the 'clients' aggregation
+    """
+    clients = []
+    for ip, res in aggregation.result().items():
+        res['begin'] = datetime.datetime.fromtimestamp(res['begin'])
+        res['end'] = datetime.datetime.fromtimestamp(res['end'])
+        clients.append((ip, res))
 
-    return (a, b)
+    return sorted(clients, key=lambda t: ip_sort_key(t[0]))
+
+
+def analyze_find_log_timeframe(records):
+    """
+    :param records: Iterable of record tuples, e.g. RecordStore.rows()
+    """
+    a = make_analyses()['timeframe']
+    acng_aggregate.run(records, [a])
+    return timeframe_result(a)
 
 
 def analyze_find_client_ips(records):
-    ips = {}
+    """
+    :param records: Iterable of record tuples, e.g. RecordStore.rows()
+    """
+    a = make_analyses()['clients']
+    acng_aggregate.run(records, [a])
+    return clients_result(a)
+
 
-    for r in records:
-        ip = r['ip']
-        if ip not in ips:
-            ips[ip] = Timerange()
+class _AggregatingStore:
+    """
+    Store like object (see read_log_chunks) which feeds the records to
+    aggregations instead of keeping them
+    """
+    def __init__(self, aggregations):
+        self._aggregations = list(aggregations)
+        self.records = 0
 
-        ips[ip].add(r['timestamp'])
+    def extend_columns(self, timestamps, dirs, sizes, ips, filenames):
+        acng_aggregate.run_columns((timestamps, dirs, sizes, ips, filenames), self._aggregations)
+        self.records += len(timestamps)
 
-    return sorted(ips.items(), key=lambda t: (ip_sort_key(t[0]), t[1]))
+    def append(self, *record):
+        acng_aggregate.run((record,), self._aggregations)
+        self.records += 1
 
+    def __len__(self):
+        return self.records
 
-def main():
-    records = read_acng_logs(LOG_FILE_PATH)
 
-    # Perform analysis
-    log_begin, log_end = analyze_find_log_timeframe(records)
-    clients = analyze_find_client_ips(records)
+def analyze_acng_log(filename, log_output=sys.stdout):
+    """
+    Compute the analyses of make_analyses on a single log file. Suitable to
+    run in a worker process.
+    """
+    analyses = make_analyses()
+    read_acng_log(filename, log_output, _AggregatingStore(analyses.values()))
+    return analyses
+
+
+def analyze_acng_logs(path, jobs=None):
+    """
+    Analyze each log file in its own worker process and merge the partial
+    results in chronological order of the log files
+    """
+    analyses = make_analyses()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for partial in executor.map(analyze_acng_log, log_filenames(path)):
+            for name, a in analyses.items():
+                a.merge(partial[name])
+
+    return analyses
+
+
+class Checkpoint:
+    """
+    Progress of incremental log processing: for each log file the number of
+    bytes which were processed, together with the aggregations of all
+    processed records.
+
+    Log files are identified by (device, inode). Since compressing a rotated
+    log creates a new inode, a file is also recognized by its first line.
+    Besides the offset, the number of processed lines is kept for messages
+    about invalid lines.
+    """
+    def __init__(self):
+        self.files = {}
+        self.analyses = make_analyses()
+
+    @staticmethod
+    def load(path):
+        if not os.path.isfile(path):
+            return Checkpoint()
+
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f)
+
+        os.replace(tmp, path)
+
+    def _find(self, s, first_line):
+        for e in self.files.values():
+            if (e['dev'], e['ino']) == (s.st_dev, s.st_ino) and e['first_line'] == first_line:
+                return e
+
+        return self.files.get(first_line)
+
+    def update(self, path, log_output=sys.stdout):
+        """
+        Process the bytes which were appended to the log files since the last
+        update.
+
+        Returns the number of new records
+        """
+        store = _AggregatingStore(self.analyses.values())
+        files = {}
+
+        for filename in log_filenames(path):
+            s = os.stat(filename)
+
+            # Fast path: unchanged file
+            e = next((e for e in self.files.values()
+                if (e['dev'], e['ino'], e['size'], e['mtime_ns']) ==
+                    (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns)), None)
+
+            if e is None:
+                with open_log(filename, binary=True) as f:
+                    first_line = f.readline()
+                    if not first_line.endswith(b'\n'):
+                        continue
+
+                    e = self._find(s, first_line) or {'first_line': first_line, 'offset': 0, 'lines': 0}
+
+                    # Truncated in place
+                    if not filename.endswith(tuple(c[0] for c in COMPRESSED_SUFFIXES)) and \
+                            s.st_size < e['offset']:
+                        e['offset'] = 0
+                        e['lines'] = 0
+
+                    f.seek(e['offset'])
+                    invalid = InvalidLines()
+                    size, lines = read_log_chunks(f, store, invalid,
+                            lineno=e.get('lines', 0), complete=False)
+
+                    e['offset'] += size
+                    e['lines'] = e.get('lines', 0) + lines
+                    _print_invalid(filename, invalid, log_output)
+
+                e.update(dev=s.st_dev, ino=s.st_ino, size=s.st_size, mtime_ns=s.st_mtime_ns)
+
+            files[e['first_line']] = e
+
+        # Forget about log files which were rotated away
+        self.files = files
+        return len(store)
+
+
+def print_report(analyses, args):
+    log_begin, log_end = timeframe_result(analyses['timeframe'])
+    clients = clients_result(analyses['clients'])
+
+    if log_begin is None:
+        print("\nLog is empty.")
+        return
 
     print("\nLog begins %s and ends %s" % (log_begin.isoformat(), log_end))
+    names = {}
+    if args.resolve:
+        cache = acng_resolve.NameCache(args.dns_cache, args.dns_ttl) if args.dns_cache else None
+        names = acng_resolve.resolve_all(
+                [cip for cip, _ in clients if not cip.startswith('[INTERNAL')],
+                timeout=args.dns_timeout, cache=cache)
+
+        if cache is not None:
+            cache.save()
+
     print("Client connections:")
-    for cip, ctimerange in clients:
+    for cip, c in clients:
         host = cip
-        if RESOLVE and not cip.startswith('[INTERNAL'):
-            name = socket.getnameinfo((cip, 0), 0)[0]
-            host += ' (' + (name if name != cip else '<not found>') + ')'
+        if cip in names:
+            name = names[cip]
+            if name is acng_resolve.TIMEOUT:
+                name = '<timeout>'
+
+            host += ' (' + (name or '<not found>') + ')'
 
         print("    %-60s (%5d times between %s and %s)" % (
-            host, len(ctimerange), ctimerange.begin(), ctimerange.end()))
+            host, c['requests'], c['begin'], c['end']))
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024
+
+    return '%.1f TiB' % n
+
+
+def print_traffic_report(report):
+    def _ratio(r):
+        return '-' if r is None else '%.1f%%' % (r * 100)
+
+    print("\nTraffic:")
+    for d in acng_store.DIR_NAMES:
+        print("    %-6s %10d requests %12s" % (d, report['requests'][d], _format_bytes(report['bytes'][d])))
+
+    print("    Cache hit ratio (bytes): %s" % _ratio(report['hit_ratio']))
+    print("    Error rate: %s" % _ratio(report['error_rate']))
+
+    print("\nServed per client:")
+    for ip, c in sorted(report['clients'].items(), key=lambda t: -t[1]['bytes']):
+        print("    %-40s %8d requests %12s %6d errors" % (
+            ip, c['requests'], _format_bytes(c['bytes']), c['errors']))
+
+    print("\nMost requested files:")
+    for fn, n in report['top_files_by_requests']:
+        print("    %8d  %s" % (n, fn))
+
+    print("\nFiles with most traffic:")
+    for fn, b in report['top_files_by_bytes']:
+        print("    %12s  %s" % (_format_bytes(b), fn))
+
+    print("\nServed over time:")
+    for t, n, b in report['histogram']:
+        print("    %s %8d requests %12s" % (datetime.datetime.fromtimestamp(t), n, _format_bytes(b)))
+
+
+def main():
+    parser = argparse.ArgumentParser('Analyze apt-cacher-ng logs')
+    parser.add_argument('--log-dir', default=LOG_FILE_PATH,
+            help="Directory with the (rotated) apt-cacher-ng logs (default: %s)" % LOG_FILE_PATH)
+    parser.add_argument('-j', '--jobs', type=int,
+            help="Number of log files to parse in parallel (default: number of CPUs)")
+    parser.add_argument('--no-resolve', dest='resolve', action='store_false', default=RESOLVE,
+            help="Do not resolve client IP addresses to host names")
+    parser.add_argument('--dns-cache',
+            help="Cache resolved host names in this file across runs")
+    parser.add_argument('--dns-ttl', type=float, default=acng_resolve.DEFAULT_TTL,
+            help="Lifetime of cached host names in seconds (default: %d)" % acng_resolve.DEFAULT_TTL)
+    parser.add_argument('--dns-timeout', type=float, default=acng_resolve.DEFAULT_TIMEOUT,
+            help="Timeout of a single lookup in seconds (default: %.1f)" % acng_resolve.DEFAULT_TIMEOUT)
+    parser.add_argument('--checkpoint',
+            help="Only process log data which was appended since the last run "
+            "and keep the progress and aggregates in this file")
+    parser.add_argument('--follow', action='store_true',
+            help="Keep watching the logs and print an updated report when new "
+            "records arrive")
+    parser.add_argument('--interval', type=float, default=FOLLOW_INTERVAL,
+            help="Polling interval of --follow in seconds (default: %d)" % FOLLOW_INTERVAL)
+    parser.add_argument('--traffic', action='store_true',
+            help="Print traffic statistics instead of the client report")
+    parser.add_argument('--top', type=int, default=10,
+            help="Number of files in the top lists of --traffic (default: 10)")
+    parser.add_argument('--bucket', choices=sorted(acng_traffic.BUCKET_SECONDS), default='day',
+            help="Granularity of the traffic histogram (default: day)")
+
+    args = parser.parse_args()
+
+    if args.traffic:
+        stats = read_acng_traffic(args.log_dir, args.bucket, jobs=args.jobs)
+        print_traffic_report(stats.report(args.top))
+        return
+
+    if not args.checkpoint and not args.follow:
+        print_report(analyze_acng_logs(args.log_dir, args.jobs), args)
+        return
+
+    cp = Checkpoint.load(args.checkpoint) if args.checkpoint else Checkpoint()
+    cnt = cp.update(args.log_dir)
+    if args.checkpoint:
+        cp.save(args.checkpoint)
+
+    if VERBOSE:
+        print("Processed %d new records." % cnt)
+
+    print_report(cp.analyses, args)
+
+    while args.follow:
+        time.sleep(args.interval)
+
+        cnt = cp.update(args.log_dir)
+        if args.checkpoint:
+            cp.save(args.checkpoint)
+
+        if cnt:
+            if VERBOSE:
+                print("\nProcessed %d new records." % cnt)
+
+            print_report(cp.analyses, args)
 
 
 #********************************* Exceptions *********************************
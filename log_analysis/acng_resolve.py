@@ -0,0 +1,146 @@
+"""
+Concurrent reverse DNS lookups with a persistent cache
+"""
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+
+DEFAULT_TIMEOUT = 3.0
+DEFAULT_WORKERS = 32
+DEFAULT_TTL = 24 * 3600
+
+
+class _Timeout:
+    def __repr__(self):
+        return 'TIMEOUT'
+
+# Result of a lookup which timed out
+TIMEOUT = _Timeout()
+
+
+def getnameinfo_resolver(ip):
+    """
+    Returns the host name of an IP address or None if it has none
+    """
+    name = socket.getnameinfo((ip, 0), 0)[0]
+    return name if name != ip else None
+
+
+class NameCache:
+    """
+    Persistent map ip -> host name (or None if the address has no name).
+    Entries expire after ttl seconds.
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._entries = {}
+
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf8') as f:
+                self._entries = json.load(f)
+
+    def get(self, ip):
+        """
+        Returns (found: bool, name)
+        """
+        e = self._entries.get(ip)
+        if e is None or time.time() - e[1] > self._ttl:
+            return (False, None)
+
+        return (True, e[0])
+
+    def set(self, ip, name):
+        self._entries[ip] = [name, time.time()]
+
+    def save(self):
+        now = time.time()
+        entries = {ip: e for ip, e in self._entries.items() if now - e[1] <= self._ttl}
+
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump(entries, f)
+
+        os.replace(tmp, self._path)
+
+
+def resolve_all(ips, resolver=getnameinfo_resolver, timeout=DEFAULT_TIMEOUT,
+        workers=DEFAULT_WORKERS, cache=None):
+    """
+    Resolve many IP addresses concurrently. A lookup which takes longer than
+    timeout seconds is abandoned; its worker thread is a daemon thread and does
+    not keep the process alive.
+
+    :param resolver: Callable resolver(ip) -> name or None
+    :param cache: NameCache or None
+
+    Returns a dict ip -> name, None if the address has no name or TIMEOUT
+    """
+    results = {}
+    todo = queue.Queue()
+
+    for ip in ips:
+        if cache is not None:
+            found, name = cache.get(ip)
+            if found:
+                results[ip] = name
+                continue
+
+        todo.put(ip)
+
+    pending = set(todo.queue)
+    started = {}
+    cond = threading.Condition()
+
+    def _work():
+        while True:
+            try:
+                ip = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            with cond:
+                started[ip] = time.monotonic()
+
+            try:
+                name = resolver(ip)
+            except (OSError, UnicodeError):
+                name = None
+
+            with cond:
+                if ip in pending:
+                    results[ip] = name
+                    pending.discard(ip)
+
+                    if cache is not None:
+                        cache.set(ip, name)
+
+                cond.notify()
+
+    for _ in range(min(workers, len(pending))):
+        threading.Thread(target=_work, daemon=True).start()
+
+    with cond:
+        while pending:
+            now = time.monotonic()
+            next_expiry = None
+
+            for ip in list(pending):
+                if ip not in started:
+                    continue
+
+                expiry = started[ip] + timeout
+                if expiry <= now:
+                    results[ip] = TIMEOUT
+                    pending.discard(ip)
+                elif next_expiry is None or expiry < next_expiry:
+                    next_expiry = expiry
+
+            if pending:
+                cond.wait(None if next_expiry is None else next_expiry - now)
+
+    return results
@@ -0,0 +1,123 @@
+"""
+Columnar storage of apt-cacher-ng log records
+"""
+import array
+import datetime
+
+
+DIR_CODES = {'O': 0, 'I': 1, 'E': 2}
+DIR_NAMES = ('out', 'in', 'error')
+
+# Fields of record tuples
+TIMESTAMP, DIR, SIZE, IP, FILENAME = range(5)
+
+
+class StringColumn:
+    """
+    Dictionary-encoded column of strings. Each distinct value is stored once,
+    rows only hold an integer code.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = array.array('I')
+        self._value_codes = {}
+
+    def encode(self, s):
+        code = self._value_codes.get(s)
+        if code is None:
+            code = len(self.values)
+            self.values.append(s)
+            self._value_codes[s] = code
+
+        return code
+
+    def append(self, s):
+        self.codes.append(self.encode(s))
+
+    def extend_values(self, values):
+        """
+        Append a sequence of strings. New values are encoded first so that the
+        codes can be looked up without a Python-level call per row.
+        """
+        for s in set(values).difference(self._value_codes):
+            self.encode(s)
+
+        self.codes.extend(map(self._value_codes.__getitem__, values))
+
+    def extend(self, other):
+        remap = [self.encode(v) for v in other.values]
+        self.codes.extend(remap[c] for c in other.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class RecordStore:
+    """
+    Log records stored column by column: timestamps (epoch seconds), sizes and
+    directions in typed arrays, client IPs and filenames dictionary-encoded.
+    """
+    def __init__(self):
+        self.timestamps = array.array('q')
+        self.dirs = array.array('B')
+        self.sizes = array.array('q')
+        self.ips = StringColumn()
+        self.filenames = StringColumn()
+
+    def append(self, ts, d, size, ip, fn):
+        """
+        :param ts: Timestamp in seconds since the epoch
+        :param d: Direction code, see DIR_CODES
+        """
+        self.timestamps.append(ts)
+        self.dirs.append(d)
+        self.sizes.append(size)
+        self.ips.append(ip)
+        self.filenames.append(fn)
+
+    def extend_columns(self, timestamps, dirs, sizes, ips, filenames):
+        """
+        Append records given column by column; ips and filenames are sequences
+        of strings.
+        """
+        self.timestamps.extend(timestamps)
+        self.dirs.extend(dirs)
+        self.sizes.extend(sizes)
+        self.ips.extend_values(ips)
+        self.filenames.extend_values(filenames)
+
+    def extend(self, other):
+        self.timestamps.extend(other.timestamps)
+        self.dirs.extend(other.dirs)
+        self.sizes.extend(other.sizes)
+        self.ips.extend(other.ips)
+        self.filenames.extend(other.filenames)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def rows(self):
+        """
+        Iterate over the records as tuples (timestamp, direction code, size,
+        ip, filename)
+        """
+        ips = self.ips.values
+        filenames = self.filenames.values
+        for ts, d, size, ip, fn in zip(self.timestamps, self.dirs, self.sizes,
+                self.ips.codes, self.filenames.codes):
+            yield (ts, d, size, ips[ip], filenames[fn])
+
+    def __getitem__(self, i):
+        """
+        A single record in the form of a dict, mainly for display
+        """
+        return {
+            'timestamp': datetime.datetime.fromtimestamp(self.timestamps[i]),
+            'dir': DIR_NAMES[self.dirs[i]],
+            'size': self.sizes[i],
+            'ip': self.ips[i],
+            'filename': self.filenames[i]
+        }
@@ -0,0 +1,174 @@
+"""
+Traffic statistics over apt-cacher-ng log records
+
+TrafficStats is fed whole columns of records at a time by the chunked log
+parser, so the records need not be kept. Most of the work is done by
+C-implemented primitives (bytes translation for direction masks,
+itertools.compress, Counter); only the bytes per client and file need a
+Python loop over the served records of each chunk.
+"""
+import collections
+import itertools
+import operator
+import acng_store
+
+
+BUCKET_SECONDS = {
+    'hour': 3600,
+    'day': 86400
+}
+
+
+_MASK_TABLES = {code: bytes(1 if i == code else 0 for i in range(256))
+        for code in acng_store.DIR_CODES.values()}
+
+
+def _direction_mask(dirs, code):
+    """
+    bytes with 1 for every record with the given direction and 0 otherwise
+    """
+    return dirs.translate(_MASK_TABLES[code])
+
+
+class TrafficStats:
+    """
+    Running traffic statistics for capacity planning. Implements the
+    extend_columns/append interface of acng_store.RecordStore so that log
+    parsers can aggregate into it directly.
+    """
+    def __init__(self, bucket='hour'):
+        self.width = BUCKET_SECONDS[bucket]
+        self.records = 0
+        self.requests = collections.Counter()
+        self.bytes = collections.Counter()
+
+        # Served traffic (and errors) by client, file and time bucket
+        self.client_requests = collections.Counter()
+        self.client_bytes = collections.Counter()
+        self.client_errors = collections.Counter()
+        self.file_requests = collections.Counter()
+        self.file_bytes = collections.Counter()
+        self.bucket_requests = collections.Counter()
+        self.bucket_bytes = collections.Counter()
+
+    def extend_columns(self, timestamps, dirs, sizes, ips, filenames):
+        """
+        Add records given column by column; ips and filenames are sequences of
+        strings.
+        """
+        dirs = bytes(dirs)
+        self.records += len(dirs)
+        self.requests.update(dirs)
+
+        out_code = acng_store.DIR_CODES['O']
+        out_mask = None
+        for code in set(dirs).intersection(_MASK_TABLES):
+            mask = _direction_mask(dirs, code)
+            self.bytes[code] += sum(itertools.compress(sizes, mask))
+            if code == out_code:
+                out_mask = mask
+
+        err_mask = _direction_mask(dirs, acng_store.DIR_CODES['E'])
+        self.client_errors.update(itertools.compress(ips, err_mask))
+
+        if out_mask is None:
+            return
+
+        out_ips = list(itertools.compress(ips, out_mask))
+        out_files = list(itertools.compress(filenames, out_mask))
+        out_sizes = list(itertools.compress(sizes, out_mask))
+        out_buckets = list(map(operator.floordiv,
+            itertools.compress(timestamps, out_mask), itertools.repeat(self.width)))
+
+        self.client_requests.update(out_ips)
+        self.file_requests.update(out_files)
+        self.bucket_requests.update(out_buckets)
+
+        # Records are mostly in chronological order, hence there are only few
+        # runs of equal buckets
+        for b, run in itertools.groupby(zip(out_buckets, out_sizes), key=operator.itemgetter(0)):
+            self.bucket_bytes[b] += sum(map(operator.itemgetter(1), run))
+
+        client_bytes = collections.defaultdict(int)
+        file_bytes = collections.defaultdict(int)
+        for ip, fn, size in zip(out_ips, out_files, out_sizes):
+            client_bytes[ip] += size
+            file_bytes[fn] += size
+
+        self.client_bytes.update(client_bytes)
+        self.file_bytes.update(file_bytes)
+
+    def append(self, ts, d, size, ip, fn):
+        self.extend_columns((ts,), (d,), (size,), (ip,), (fn,))
+
+    def __len__(self):
+        return self.records
+
+    def merge(self, other):
+        """
+        Add the statistics of other, which must have the same bucket width
+        """
+        self.records += other.records
+        for name in ('requests', 'bytes', 'client_requests', 'client_bytes', 'client_errors',
+                'file_requests', 'file_bytes', 'bucket_requests', 'bucket_bytes'):
+            getattr(self, name).update(getattr(other, name))
+
+    def report(self, top_n=10):
+        """
+        Returns a dict with
+            'requests', 'bytes': totals per direction name
+            'hit_ratio': share of served bytes which did not have to be
+                fetched from upstream, clamped to [0, 1] since more bytes may
+                be fetched than served (e.g. aborted downloads)
+            'error_rate': share of requests which failed
+            'clients': ip -> {'requests', 'bytes', 'errors'} (served traffic)
+            'top_files_by_requests', 'top_files_by_bytes': [(filename, value)]
+            'histogram': [(bucket start in seconds since the epoch, requests,
+                bytes)] of served traffic
+        """
+        names = acng_store.DIR_NAMES
+        requests = {names[c]: self.requests[c] for c in range(len(names))}
+        total_bytes = {names[c]: self.bytes[c] for c in range(len(names))}
+
+        served = total_bytes['out']
+        fetched = total_bytes['in']
+        hit_ratio = min(1.0, max(0.0, 1 - fetched / served)) if served else None
+        error_rate = requests['error'] / self.records if self.records else None
+
+        clients = {}
+        for ip in set(self.client_requests) | set(self.client_errors):
+            clients[ip] = {
+                'requests': self.client_requests[ip],
+                'bytes': self.client_bytes[ip],
+                'errors': self.client_errors[ip]
+            }
+
+        top_bytes = sorted(((fn, b) for fn, b in self.file_bytes.items() if b),
+                key=lambda t: -t[1])[:top_n]
+
+        histogram = [(b * self.width, self.bucket_requests[b], self.bucket_bytes[b])
+                for b in sorted(self.bucket_requests)]
+
+        return {
+            'requests': requests,
+            'bytes': total_bytes,
+            'hit_ratio': hit_ratio,
+            'error_rate': error_rate,
+            'clients': clients,
+            'top_files_by_requests': self.file_requests.most_common(top_n),
+            'top_files_by_bytes': top_bytes,
+            'histogram': histogram
+        }
+
+
+def traffic_report(store, top_n=10, bucket='hour'):
+    """
+    Compute traffic statistics of an acng_store.RecordStore, see
+    TrafficStats.report
+    """
+    stats = TrafficStats(bucket)
+    stats.extend_columns(store.timestamps, store.dirs, store.sizes,
+            list(map(store.ips.values.__getitem__, store.ips.codes)),
+            list(map(store.filenames.values.__getitem__, store.filenames.codes)))
+
+    return stats.report(top_n)
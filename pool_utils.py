@@ -0,0 +1,50 @@
+"""
+Helpers for running many small tasks on a concurrent.futures executor
+"""
+import collections
+import concurrent.futures
+
+
+def bounded_map(executor, tasks, window):
+    """
+    Run tasks on an executor with at most window futures queued at a time,
+    so that the remaining tasks wait in a compact form and are only created
+    as needed. Yields the results in the order of completion; pending futures
+    are cancelled if the caller stops early or an exception is raised.
+
+    :param tasks: Iterable of (function, args). A collections.deque is
+        consumed from the left, hence further tasks may be appended to it
+        while the results are processed.
+    """
+    if isinstance(tasks, collections.deque):
+        def _next():
+            return tasks.popleft() if tasks else None
+    else:
+        it = iter(tasks)
+
+        def _next():
+            return next(it, None)
+
+    pending = set()
+    try:
+        while True:
+            while len(pending) < window:
+                task = _next()
+                if task is None:
+                    break
+
+                func, args = task
+                pending.add(executor.submit(func, *args))
+
+            if not pending:
+                return
+
+            done, pending = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for fut in done:
+                yield fut.result()
+
+    finally:
+        for fut in pending:
+            fut.cancel()
@@ -0,0 +1,163 @@
+"""
+Parallel comparison of two directory trees
+"""
+import collections
+import concurrent.futures
+import os
+import stat
+import pool_utils
+
+
+BLOCK_SIZE = 1 << 20
+DEFAULT_WORKERS = 16
+
+# reason is e.g. 'type', 'missing', 'file size', 'file content' or
+# 'symlink target'
+Difference = collections.namedtuple('Difference', ['ref', 'test', 'reason'])
+
+
+def _same_inode(s1, s2):
+    return (s1.st_dev, s1.st_ino) == (s2.st_dev, s2.st_ino)
+
+
+def compare_content(refp, testp, block_size=BLOCK_SIZE):
+    """
+    Returns True if both files have the same content. Files are read in
+    large blocks into preallocated buffers.
+    """
+    with open(refp, 'rb', buffering=0) as f1, open(testp, 'rb', buffering=0) as f2:
+        for f in (f1, f2):
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        b1 = bytearray(block_size)
+        b2 = bytearray(block_size)
+        m1 = memoryview(b1)
+        m2 = memoryview(b2)
+
+        while True:
+            n1 = f1.readinto(b1)
+            n2 = f2.readinto(b2)
+
+            # Short reads are possible on some file systems; fill up
+            while n2 < n1:
+                n = f2.readinto(m2[n2:n1])
+                if not n:
+                    break
+                n2 += n
+
+            while n1 < n2:
+                n = f1.readinto(m1[n1:n2])
+                if not n:
+                    break
+                n1 += n
+
+            if n1 != n2:
+                return False
+
+            # Comparing bytearrays uses memcmp, unlike memoryviews
+            if n1 == block_size:
+                if b1 != b2:
+                    return False
+            elif b1[:n1] != b2[:n2]:
+                return False
+
+            if n1 == 0:
+                return True
+
+
+class TreeComparer:
+    """
+    Compares a test tree against a reference tree. Directories are listed and
+    files compared on a thread pool; all differences are reported, entries
+    which only exist in the test tree are ignored.
+
+    Files with different sizes are not read, neither are paths which refer to
+    the same inode (e.g. hardlinked backup snapshots).
+
+    :param report: Callable report(Difference), called from the thread which
+        runs compare()
+    """
+    def __init__(self, report, workers=DEFAULT_WORKERS, block_size=BLOCK_SIZE):
+        self.report = report
+        self.workers = workers
+        self.block_size = block_size
+
+    def _compare_stat(self, refp, testp, s1, s2, diffs, tasks):
+        """
+        Compare two entries based on their stat results. Further work is
+        appended to tasks as (function, args).
+        """
+        if stat.S_IFMT(s1.st_mode) != stat.S_IFMT(s2.st_mode):
+            diffs.append(Difference(refp, testp, 'type'))
+
+        elif _same_inode(s1, s2):
+            pass
+
+        elif stat.S_ISDIR(s1.st_mode):
+            tasks.append((self._compare_dir, (refp, testp)))
+
+        elif stat.S_ISREG(s1.st_mode):
+            if s1.st_size != s2.st_size:
+                diffs.append(Difference(refp, testp, 'file size'))
+            elif s1.st_size > 0:
+                tasks.append((self._compare_file, (refp, testp)))
+
+        elif stat.S_ISLNK(s1.st_mode):
+            if os.readlink(refp) != os.readlink(testp):
+                diffs.append(Difference(refp, testp, 'symlink target'))
+
+        else:
+            raise RuntimeError("Unsupported filetype: %x" % (s1.st_mode))
+
+    def _compare_root(self, refp, testp):
+        diffs = []
+        tasks = []
+        self._compare_stat(refp, testp, os.lstat(refp), os.lstat(testp), diffs, tasks)
+        return (diffs, tasks)
+
+    def _compare_dir(self, refp, testp):
+        with os.scandir(refp) as it:
+            c1 = {e.name: e for e in it}
+
+        with os.scandir(testp) as it:
+            c2 = {e.name: e for e in it}
+
+        diffs = []
+        tasks = []
+
+        for name in sorted(c1):
+            e1 = c1[name]
+            e2 = c2.get(name)
+
+            if e2 is None:
+                diffs.append(Difference(e1.path, os.path.join(testp, name), 'missing'))
+                continue
+
+            self._compare_stat(e1.path, e2.path, e1.stat(follow_symlinks=False),
+                    e2.stat(follow_symlinks=False), diffs, tasks)
+
+        return (diffs, tasks)
+
+    def _compare_file(self, refp, testp):
+        if compare_content(refp, testp, self.block_size):
+            return ([], [])
+
+        return ([Difference(refp, testp, 'file content')], [])
+
+    def compare(self, refdir, testdir):
+        """
+        Returns True if no differences were found
+        """
+        equal = True
+        todo = collections.deque([(self._compare_root, (refdir, testdir))])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for diffs, tasks in pool_utils.bounded_map(executor, todo, 4 * self.workers):
+                for d in diffs:
+                    equal = False
+                    self.report(d)
+
+                todo.extend(tasks)
+
+        return equal
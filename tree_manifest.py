@@ -0,0 +1,252 @@
+"""
+Manifests of directory trees: type, mode, size, symlink target and content
+hash of every entry, for comparing trees which are not mounted on the same
+machine.
+
+A manifest is a file of JSON lines (gzip-compressed if its name ends with
+.gz). The first line is a header, every further line an entry
+[path, type, mode, size, mtime_ns, ino, digest] with the path relative to the
+tree's root ('.' for the root itself). digest is the SHA-256 of a regular
+file, the target of a symlink and None for directories.
+"""
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import stat
+import pool_utils
+import tree_compare
+
+
+FORMAT = 'dir_compare manifest'
+VERSION = 1
+HASH = 'sha256'
+
+Entry = collections.namedtuple('Entry', ['type', 'mode', 'size', 'mtime_ns', 'ino', 'digest'])
+
+
+def hash_file(path, block_size=tree_compare.BLOCK_SIZE):
+    h = hashlib.new(HASH)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+
+            h.update(view[:n])
+
+    return h.hexdigest()
+
+
+def _entry(path, s):
+    """
+    Entry from stat results without the content hash of regular files
+    """
+    if stat.S_ISDIR(s.st_mode):
+        t, digest = 'd', None
+    elif stat.S_ISREG(s.st_mode):
+        t, digest = 'f', None
+    elif stat.S_ISLNK(s.st_mode):
+        t, digest = 'l', os.readlink(path)
+    else:
+        raise RuntimeError("Unsupported filetype: %x" % (s.st_mode))
+
+    return Entry(t, stat.S_IMODE(s.st_mode), s.st_size if t == 'f' else 0,
+            s.st_mtime_ns, s.st_ino, digest)
+
+
+def scan_tree(root):
+    """
+    Walk a tree without reading file contents.
+
+    Returns a dict relative path -> Entry in which regular files have no
+    digest yet
+    """
+    entries = {'.': _entry(root, os.lstat(root))}
+    if entries['.'].type != 'd':
+        return entries
+
+    stack = ['.']
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            children = sorted(it, key=lambda e: e.name)
+
+        for e in children:
+            crel = e.name if rel == '.' else rel + '/' + e.name
+            entries[crel] = _entry(e.path, e.stat(follow_symlinks=False))
+            if entries[crel].type == 'd':
+                stack.append(crel)
+
+    return entries
+
+
+def hash_entries(root, entries, paths, workers=tree_compare.DEFAULT_WORKERS):
+    """
+    Fill in the digests of the regular files paths of entries, reading them
+    on a thread pool
+    """
+    def _hash(rel):
+        return (rel, hash_file(os.path.join(root, rel)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for rel, digest in pool_utils.bounded_map(executor,
+                ((_hash, (rel,)) for rel in paths), 4 * workers):
+            entries[rel] = entries[rel]._replace(digest=digest)
+
+
+def build_manifest(root, previous=None, workers=tree_compare.DEFAULT_WORKERS):
+    """
+    Scan and hash a tree. Digests of regular files whose size, mtime_ns and
+    inode number match the previous manifest are reused.
+
+    :param previous: dict as returned by read_manifest or None
+
+    Returns (dict relative path -> Entry, number of hashed files)
+    """
+    entries = scan_tree(root)
+    todo = []
+
+    for rel, e in entries.items():
+        if e.type != 'f':
+            continue
+
+        p = previous.get(rel) if previous else None
+        if p is not None and p.type == 'f' and (p.size, p.mtime_ns, p.ino) == (e.size, e.mtime_ns, e.ino):
+            entries[rel] = e._replace(digest=p.digest)
+        else:
+            todo.append(rel)
+
+    hash_entries(root, entries, todo, workers)
+    return (entries, len(todo))
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+
+    return open(path, mode, encoding='utf8')
+
+
+def write_manifest(path, entries):
+    tmp = path + '.tmp' + ('.gz' if path.endswith('.gz') else '')
+    with _open(tmp, 'w') as f:
+        json.dump({'format': FORMAT, 'version': VERSION, 'hash': HASH}, f)
+        f.write('\n')
+
+        for rel, e in sorted(entries.items()):
+            json.dump([rel] + list(e), f)
+            f.write('\n')
+
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    """
+    Returns a dict relative path -> Entry
+    """
+    with _open(path, 'r') as f:
+        try:
+            header = json.loads(f.readline())
+        except (ValueError, EOFError):
+            header = None
+
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise InvalidManifest("'%s' is not a manifest" % path)
+
+        if header.get('version') != VERSION or header.get('hash') != HASH:
+            raise InvalidManifest("Unsupported manifest version or hash of '%s'" % path)
+
+        entries = {}
+        for line in f:
+            t = json.loads(line)
+            entries[t[0]] = Entry(*t[1:])
+
+        return entries
+
+
+def compare_manifests(ref, test, report, ref_root=None, test_root=None,
+        workers=tree_compare.DEFAULT_WORKERS):
+    """
+    Compare two manifests like tree_compare.TreeComparer compares trees; in
+    addition, permission bits are compared. Entries which only exist in test
+    are ignored, as are the descendants of directories which are missing in
+    test or have a different type there.
+
+    :param report: Callable report(tree_compare.Difference); paths are
+        relative to the manifest's root or, for a manifest created by
+        scan_tree, joined onto the tree's root
+    :param ref_root, test_root: If the manifest was created by scan_tree, the
+        tree's root. Regular files of equal size are hashed on demand then.
+
+    Returns True if no differences were found
+    """
+    def _path(root, rel):
+        if root is None:
+            return rel
+
+        return root if rel == '.' else os.path.join(root, rel)
+
+    diffs = []
+    todo = []
+    skipped = set()
+
+    # Sorted, a directory comes before its descendants
+    for rel in sorted(ref):
+        if rel != '.' and (rel.rpartition('/')[0] or '.') in skipped:
+            skipped.add(rel)
+            continue
+
+        r = ref[rel]
+        t = test.get(rel)
+        if t is None:
+            reason = 'missing'
+        elif r.type != t.type:
+            reason = 'type'
+        elif r.mode != t.mode:
+            reason = 'mode'
+        elif r.type == 'l' and r.digest != t.digest:
+            reason = 'symlink target'
+        elif r.type == 'f' and r.size != t.size:
+            reason = 'file size'
+        else:
+            if r.type == 'f' and (r.digest is None or t.digest is None):
+                todo.append(rel)
+            elif r.type == 'f' and r.digest != t.digest:
+                diffs.append((rel, 'file content'))
+
+            continue
+
+        if reason in ('missing', 'type'):
+            skipped.add(rel)
+
+        diffs.append((rel, reason))
+
+    for entries, root in ((ref, ref_root), (test, test_root)):
+        paths = [rel for rel in todo if entries[rel].digest is None]
+        if paths:
+            if root is None:
+                raise ValueError("Manifest lacks digests")
+
+            hash_entries(root, entries, paths, workers)
+
+    if todo:
+        diffs += [(rel, 'file content') for rel in todo if ref[rel].digest != test[rel].digest]
+
+    for rel, reason in diffs:
+        report(tree_compare.Difference(_path(ref_root, rel), _path(test_root, rel), reason))
+
+    return not diffs
+
+
+#********************************* Exceptions *********************************
+class InvalidManifest(Exception):
+    pass